@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Benchmarks for the psl_build data structures
+
+    python bench.py tree [nodes] [revision]
+    python bench.py build [nodes]
+    python bench.py scan [directory] [latency ms]
+
+tree: memory and build time of a tree.tree against the tree.py of a git
+revision, by default the first commit, i.e. the tree with __dict__ nodes, weak
+references and a global map of nodes to trees. each measurement runs in its
+own process
+
+build: time to build a tree one add_node call at a time against one
+tree.from_edges call
+
+scan: time to collect the source files beneath directory with the two
+os.walk passes psl_build used to make, against one sources.source_finder walk
+with 1 and 8 jobs. latency is added to every directory read to stand in for a
+network file system
+
+"""
+import sys, os, re, time, random, resource, imp
+from subprocess import Popen, PIPE
+import tree, sources
+
+def load_tree(revision):
+    # return the tree module of a git revision, loaded apart from tree
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd  = ['git', 'show', '%s:tree.py' % revision]
+    code = Popen(cmd, stdout=PIPE, cwd=here).communicate()[0]
+    module = imp.new_module('tree_' + revision)
+    exec compile(code, 'tree.py@' + revision, 'exec') in module.__dict__
+    return module
+
+def first_commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd  = ['git', 'rev-list', '--max-parents=0', 'HEAD']
+    return Popen(cmd, stdout=PIPE, cwd=here).communicate()[0].split()[-1]
+
+def build_tree(module, size):
+    # random tree of size nodes, similar in shape to an include tree
+    rnd = random.Random(0)
+    t = module.tree()
+    ids = ['n0']
+    t.add_node('n0')
+    for i in xrange(1, size):
+        ids.append('n%d' % i)
+        t.add_node(ids[-1], parent=ids[rnd.randrange(len(ids) - 1)])
+    return t
+
+def random_edges(size):
+    # (parent, child) pairs of the same random tree as build_tree
+    rnd = random.Random(0)
+    ids = ['n0']
+    for i in xrange(1, size):
+        ids.append('n%d' % i)
+        yield ids[rnd.randrange(len(ids) - 1)], ids[-1]
+
+def tree_child(revision, size):
+    # runs in a child process: print kilobytes and seconds used by the tree
+    # of revision, or of the working tree if revision is '-'
+    if revision == '-':
+        module = tree
+    else:
+        module = load_tree(revision)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start  = time.time()
+    t = build_tree(module, size)
+    elapsed = time.time() - start
+    after  = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print after - before, elapsed
+
+def tree_memory(size=100000, revision=None):
+    revision = revision or first_commit()
+    print 'tree of %d nodes' % size
+    for name, rev in ((revision[:10], revision), ('current', '-')):
+        cmd = [sys.executable, os.path.abspath(__file__), 'tree-child', rev, str(size)]
+        kb, sec = Popen(cmd, stdout=PIPE).communicate()[0].split()
+        print '  %-10s %8d kB %6.1f bytes/node %6.2f s' % (
+                name, int(kb), int(kb) * 1024.0 / size, float(sec))
+
+def tree_build(size=100000):
+    print 'tree of %d nodes' % size
+    edges = list(random_edges(size))
+    start = time.time()
+    build_tree(tree, size)
+    print '  %-10s %6.3f s' % ('add_node', time.time() - start)
+    start = time.time()
+    tree.tree.from_edges(edges)
+    print '  %-10s %6.3f s' % ('from_edges', time.time() - start)
+
+def double_walk(top, exclude_dirs, exclude_files):
+    # source collection as psl_build did it before sources.source_finder. one
+    # walk to count files, then one to collect them, testing each pattern
+    possible = 0
+    for dirpath, dirs, filenames in os.walk(top):
+        possible += len(filenames)
+    found = []
+    for dirpath, dirs, filenames in os.walk(top):
+        if [x for x in exclude_dirs if re.search(x, dirpath)]:
+            continue
+        for filename in filenames:
+            if not [x for x in exclude_files if re.search(x, filename)]:
+                found.append(filename)
+    return found
+
+def source_walk(top, exclude_dirs, exclude_files, jobs):
+    finder = sources.source_finder(exclude_dirs, exclude_files)
+    return [name for kind, name, pth in finder.walk([top], jobs)
+            if kind == sources.FILE]
+
+def source_scan(top='.', latency=0):
+    import psl_build
+    exclude_dirs  = psl_build.exclude_dirs
+    exclude_files = psl_build.exclude_files
+    # each directory read of either walk waits for latency milliseconds
+    listdir = os.listdir
+    def slow_listdir(pth):
+        time.sleep(latency / 1000.0)
+        return listdir(pth)
+    os.listdir = slow_listdir
+    if sources.scandir is not None:
+        scandir = sources.scandir
+        def slow_scandir(pth):
+            time.sleep(latency / 1000.0)
+            return scandir(pth)
+        sources.scandir = slow_scandir
+
+    print 'source files beneath %s, %d ms per directory read' % (top, latency)
+    runs = [('os.walk x2', lambda: double_walk(top, exclude_dirs, exclude_files)),
+            ('1 job', lambda: source_walk(top, exclude_dirs, exclude_files, 1)),
+            ('8 jobs', lambda: source_walk(top, exclude_dirs, exclude_files, 8))]
+    for name, run in runs:
+        start = time.time()
+        found = run()
+        print '  %-10s %6d files %6.2f s' % (name, len(found), time.time() - start)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'tree-child':
+        tree_child(sys.argv[2], int(sys.argv[3]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'tree':
+        tree_memory(*([int(x) for x in sys.argv[2:3]] + sys.argv[3:4]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'build':
+        tree_build(*[int(x) for x in sys.argv[2:3]])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'scan':
+        source_scan(*(sys.argv[2:3] + [int(x) for x in sys.argv[3:4]]))
+    else:
+        print __doc__
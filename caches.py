@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Results of psl_build steps kept on disk between runs
+
+A result cache is a directory of marshal files, one per entry, named by a
+fingerprint of everything the result depends on. An entry is only found again
+when none of its inputs have changed, so entries are never updated in place.
+
+The modification time of an entry is the last time it was used. Entries which
+have not been used for max_age seconds are evicted, and the least recently
+used entries are evicted while the directory holds more than max_size bytes.
+
+"""
+import os, time, marshal, hashlib
+
+def fingerprint(*parts):
+    """Return a hex digest of parts, which can be any values marshal can
+    write, e.g. strings, numbers and lists, tuples and dicts of them
+
+    """
+    return hashlib.sha1(marshal.dumps(parts)).hexdigest()
+
+
+class result_cache(object):
+
+    """Directory of results keyed by fingerprint, evicted by age and size
+
+    """
+    version = 1
+
+    def __init__(self, location, max_age=7*24*3600, max_size=64*1024*1024):
+        self.location = location
+        self.max_age  = max_age
+        self.max_size = max_size
+
+    def get(self, key):
+        # return the result stored under key, or None
+        pth = os.path.join(self.location, key)
+        try:
+            if os.stat(pth).st_mtime < time.time() - self.max_age:
+                os.remove(pth)
+                return None
+            f = open(pth, 'rb')
+            try:
+                version, value = marshal.loads(f.read())
+            finally:
+                f.close()
+            # mark the entry as used
+            os.utime(pth, None)
+        except (OSError, IOError, EOFError, ValueError, TypeError):
+            # missing or unreadable entry
+            return None
+        if version != result_cache.version:
+            return None
+        return value
+
+    def put(self, key, value):
+        # store value under key, then evict old entries
+        if not os.path.isdir(self.location):
+            os.makedirs(self.location)
+        pth = os.path.join(self.location, key)
+        # write to a temporary file first so an interrupted write can't leave
+        # a truncated entry behind
+        tmp = pth + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(marshal.dumps((result_cache.version, value)))
+        finally:
+            f.close()
+        os.rename(tmp, pth)
+        self.evict()
+
+    def evict(self):
+        """Remove entries unused for max_age seconds, then the least recently
+        used entries until the cache holds at most max_size bytes
+
+        returns the number of entries removed
+
+        """
+        try:
+            names = os.listdir(self.location)
+        except OSError:
+            return 0
+        oldest  = time.time() - self.max_age
+        entries = []
+        for name in names:
+            pth = os.path.join(self.location, name)
+            try:
+                st = os.stat(pth)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, pth))
+        entries.sort()
+
+        removed = 0
+        total = sum(size for mtime, size, pth in entries)
+        for mtime, size, pth in entries:
+            if mtime >= oldest and total <= self.max_size:
+                break
+            try:
+                os.remove(pth)
+            except OSError:
+                continue
+            total   -= size
+            removed += 1
+        return removed
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Parse and index the contents of fnl files
+
+An fnl file is made up of sections, each starting with a line beginning with
+'**' and naming the section, e.g. '** HANDLE', followed by its entries. Each
+fnl file is parsed once into an fnl_file and kept in a cache keyed by path and
+mtime.
+
+Every fnl file in a directory is indexed to record the names listed in it,
+with their line numbers, and the fnl's HANDLE. Finding the fnl files which
+list a set of source files or handles is then a dictionary lookup instead of
+a grep over every fnl file.
+
+A directory of fnl files can be kept as a mirror. Its manifest records the
+upstream version of each fnl so that only new or changed fnl files are
+fetched again.
+
+The contents of a directory of fnl files can be reduced to a fingerprint, so
+results derived from the fnl files can be reused while they are unchanged.
+
+"""
+import os, re, glob, marshal, hashlib
+from collections import OrderedDict
+
+# line starting a section, e.g. '** HANDLE'
+section_rgx = re.compile(r'^\*\*\W*(\w*)')
+# line holding a single name, i.e. a source file or handle entry
+name_rgx    = re.compile(r'^ *([a-zA-Z][\w.-]*) *$')
+# line holding the first word of a parameter
+param_rgx   = re.compile(r'^\s*(\w\S+)')
+
+class fnl_file(object):
+
+    """Sections and entries of a single fnl file
+
+    The first entry of each section is available as an attribute named after
+    the section, e.g. fnl.HANDLE
+
+    """
+
+    def __init__(self, pth):
+        self.path     = pth
+        self.name     = os.path.basename(pth)
+        self.sections = []   # list of (section line, section name, entries)
+        self.names    = []   # list of (name, line number) of single name lines
+        self._parse()
+
+    def _parse(self):
+        # entries before the first section belong to an unnamed section
+        entries = []
+        self.sections.append(('', '', entries))
+        f = open(self.path, 'r')
+        for num, line in enumerate(f, 1):
+            m = section_rgx.match(line)
+            if m:
+                entries = []
+                self.sections.append((line, m.group(1), entries))
+                continue
+            m = param_rgx.search(line)
+            if m:
+                # entry is a (parameter, line number) pair
+                entries.append((m.group(1), num))
+            m = name_rgx.match(line.rstrip('\r\n'))
+            if m:
+                self.names.append((m.group(1), num))
+        f.close()
+
+    def get_param(self, param):
+        """Return the first entry, and its line number, of the first section
+        whose section line contains param, or None
+
+        """
+        for line, name, entries in self.sections:
+            if param in line:
+                if entries:
+                    return entries[0]
+                return None
+        return None
+
+    def get_section(self, name):
+        # return list of (entry, line number) of the named section
+        for line, sname, entries in self.sections:
+            if sname == name:
+                return entries
+        return []
+
+    def __getattr__(self, name):
+        for line, sname, entries in self.__dict__.get('sections', ()):
+            if sname == name:
+                if entries:
+                    return entries[0][0]
+                return None
+        raise AttributeError('%s has no section %s' % (self.name, name))
+
+    def __repr__(self):
+        return 'fnl_file(%s)' % self.path
+
+
+class fnl_cache(object):
+
+    """Least recently used cache of parsed fnl files keyed by path and mtime
+
+    """
+
+    def __init__(self, size=4096):
+        self.size    = size
+        self.entries = OrderedDict()   # path -> (mtime, fnl_file)
+
+    def get(self, pth):
+        mtime = os.stat(pth).st_mtime
+        rec = self.entries.pop(pth, None)
+        if rec is None or rec[0] != mtime:
+            rec = (mtime, fnl_file(pth))
+        # most recently used entries are kept at the end
+        self.entries[pth] = rec
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return rec[1]
+
+    def clear(self):
+        self.entries.clear()
+
+# cache shared by all fnl lookups
+cache = fnl_cache()
+
+def get(pth):
+    """Return the parsed fnl_file of pth from the shared cache
+
+    """
+    return cache.get(pth)
+
+
+def fingerprint(location):
+    """Return a hex digest of the names and contents of the fnl files in
+    location. fetched fnl files are new files on every run, so their contents
+    rather than their mtimes are compared
+
+    """
+    md5 = hashlib.md5()
+    for pth in sorted(glob.glob(location + '/*')):
+        if not os.path.isfile(pth):
+            continue
+        f = open(pth, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        md5.update('%s\0%d\0' % (os.path.basename(pth), len(data)))
+        md5.update(data)
+    return md5.hexdigest()
+
+
+class fnl_index(object):
+
+    """Map of names to the fnl files and line numbers listing them
+
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self.fnls    = []   # fnl file names, in directory order
+        self.names   = {}   # name -> list of (fnl file, line number)
+        self.handles = {}   # fnl file -> (handle, line number)
+        for pth in glob.glob(location + '/*'):
+            if os.path.isfile(pth):
+                self._read(pth)
+
+    def _read(self, pth):
+        fnl   = get(pth)
+        order = len(self.fnls)
+        self.fnls.append(fnl.name)
+        hdr = fnl.get_param('HANDLE')
+        if hdr:
+            self.handles[fnl.name] = hdr
+        for name, num in fnl.names:
+            self.names.setdefault(name, []).append((order, num))
+
+    def get_handle(self, f_name):
+        # return handle and handle line number of fnl file, or None
+        return self.handles.get(f_name)
+
+    def find(self, names):
+        """Return (fnl file, line number, name) for every fnl entry of names,
+        ordered by fnl file then line number
+
+        """
+        hits = []
+        for name in set(names):
+            for order, num in self.names.get(name, ()):
+                hits.append((order, num, name))
+        hits.sort()
+        return [(self.fnls[order], num, name) for order, num, name in hits]
+
+
+class fnl_manifest(object):
+
+    """Upstream version, mtime, size and md5 of each fnl file in a mirror
+
+    """
+    version = 1
+
+    def __init__(self, location):
+        self.location = location
+        self.path     = os.path.join(location, '.manifest')
+        self.entries  = {}   # fnl file -> (upstream version, mtime, size, md5)
+        self.changed  = False
+        try:
+            f = open(self.path, 'rb')
+            try:
+                version, entries = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            # missing or unreadable manifest. every fnl will be fetched
+            return
+        if version == fnl_manifest.version:
+            self.entries = entries
+
+    def is_current(self, name, version):
+        """Return True if the mirrored fnl is the upstream version and has not
+        been touched since it was fetched
+
+        """
+        rec = self.entries.get(name)
+        if not rec or rec[0] != version:
+            return False
+        try:
+            st = os.stat(os.path.join(self.location, name))
+        except OSError:
+            return False
+        return st.st_mtime == rec[1] and st.st_size == rec[2]
+
+    def record(self, name, version):
+        # record a freshly fetched fnl
+        pth = os.path.join(self.location, name)
+        st = os.stat(pth)
+        f = open(pth, 'rb')
+        try:
+            md5 = hashlib.md5(f.read()).hexdigest()
+        finally:
+            f.close()
+        self.entries[name] = (version, st.st_mtime, st.st_size, md5)
+        self.changed = True
+
+    def discard(self, name):
+        # remove an fnl which is no longer listed upstream
+        self.entries.pop(name, None)
+        try:
+            os.remove(os.path.join(self.location, name))
+        except OSError:
+            pass
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            marshal.dump((fnl_manifest.version, self.entries), f)
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+        self.changed = False
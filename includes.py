@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Reverse include graph of psl source files
+
+The graph maps each included file to the files which include it, so that all
+files affected by a set of source files can be found with one in-memory
+breadth first search rather than a grep over the includes list per level.
+
+The graph is kept on disk as an include index. Each source file is recorded
+with its mtime, size and #include targets, and only files which have changed
+since the index was saved are read again.
+
+"""
+import os, re, marshal
+
+# include directive in a source file, e.g. '#include "file.h"'
+include_rgx = re.compile(r'^\s*#\s*include\s*["<]([^">]+)[">]', re.M)
+# files which are scanned for include directives
+source_rgx  = re.compile(r'\.[ch](pp)?$')
+
+class include_graph(object):
+
+    """Inverted index from included file to the files which include it
+
+    """
+
+    def __init__(self):
+        self.includers = {}   # included file -> list of including files
+
+    def add(self, src, inc):
+        # record that src includes inc
+        self.includers.setdefault(inc, []).append(src)
+
+    def remove(self, src, inc):
+        # forget that src includes inc
+        lst = self.includers.get(inc)
+        if lst and src in lst:
+            lst.remove(src)
+            if not lst:
+                del self.includers[inc]
+
+    def get_includers(self, inc):
+        return self.includers.get(inc, [])
+
+
+class include_index(include_graph):
+
+    """Include graph persisted to a file and refreshed from source file mtimes
+
+    """
+    version = 1
+
+    def __init__(self, location):
+        include_graph.__init__(self)
+        self.location = location
+        self.files    = {}      # path -> (mtime, size, list of includes)
+        self.changed  = False
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.location, 'rb')
+            try:
+                version, files, includers = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            # missing or unreadable index. start from scratch
+            return
+        if version == include_index.version:
+            self.files     = files
+            self.includers = includers
+
+    def save(self):
+        if not self.changed:
+            return
+        # write to a temporary file first so an interrupted save can't
+        # leave a truncated index behind
+        tmp = self.location + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            marshal.dump((include_index.version, self.files, self.includers), f)
+        finally:
+            f.close()
+        os.rename(tmp, self.location)
+        self.changed = False
+
+    def refresh(self, dirs, exclude_dirs=()):
+        """Bring the index up to date with the source files beneath dirs
+
+        returns the number of files parsed and the number of files removed
+
+        """
+        if exclude_dirs:
+            exclude = re.compile('|'.join(exclude_dirs))
+        else:
+            exclude = None
+
+        parsed = 0
+        found  = set()
+        for entry in dirs:
+            for (dirpath, dirnames, filenames) in os.walk(entry):
+                if exclude:
+                    dirnames[:] = [d for d in dirnames if not exclude.search(d)]
+                for filename in filenames:
+                    if not source_rgx.search(filename):
+                        continue
+                    pth = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(pth)
+                    except OSError:
+                        continue
+                    found.add(pth)
+                    rec = self.files.get(pth)
+                    if rec and rec[0] == st.st_mtime and rec[1] == st.st_size:
+                        continue
+                    self._update(pth, (st.st_mtime, st.st_size, self.parse(pth)))
+                    parsed += 1
+
+        removed = [pth for pth in self.files if pth not in found]
+        for pth in removed:
+            self._update(pth, None)
+        return parsed, len(removed)
+
+    # replace the index record of path with rec, or drop it if rec is None
+    def _update(self, pth, rec):
+        src = os.path.basename(pth)
+        old = self.files.pop(pth, None)
+        if old:
+            for inc in old[2]:
+                self.remove(src, inc)
+        if rec:
+            self.files[pth] = rec
+            for inc in rec[2]:
+                self.add(src, inc)
+        self.changed = True
+
+    @staticmethod
+    def parse(pth):
+        # return list of files included by the source file
+        try:
+            f = open(pth, 'r')
+            try:
+                return include_rgx.findall(f.read())
+            finally:
+                f.close()
+        except IOError:
+            return []
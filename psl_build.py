@@ -15,17 +15,20 @@ local directory, using psl commands.
 """
 
 # import sys, getopt, os, re, tempfile, shutil
-import sys, os, re, tempfile, shutil, time, glob
+import sys, os, re, tempfile, shutil, time, glob, threading, Queue, atexit, hashlib
+import pipes, marshal
+from cStringIO import StringIO
 from optparse import OptionParser
 from subprocess import Popen, PIPE, STDOUT
-import tree
+import tree, includes, fnls, caches, sources
 
 start_time = time.time()
 ################################################################################
 # set global variables
 ################################################################################
-exclude_dirs  = set(['SPARC_SOL','WRSGNUPPC604','MERCURY','GEN_TGT','.fnl_files','build_results'])
-exclude_files = set(['~$','all_includes'])
+exclude_dirs  = set(['SPARC_SOL','WRSGNUPPC604','MERCURY','GEN_TGT','.fnl_files',
+    '.catalog_cache','.build_cache','.env_cache','build_results'])
+exclude_files = set(['~$','all_includes','^\.include_index'])
 local_source_files = []
 build_files = []
 handles = []
@@ -35,9 +38,20 @@ handles = []
 # support = bin_loc + '/support_binaries'
 cwd      = os.path.abspath(os.getcwd())
 fnl_loc  = cwd + '/.fnl_files'
+inc_loc  = cwd + '/.include_index'
+cat_loc  = cwd + '/.catalog_cache'
+bld_loc  = cwd + '/.build_cache'
+env_loc  = cwd + '/.env_cache'
 bin_loc  = cwd + '/build_results'
 support  = bin_loc + '/support_binaries'
 log_file = bin_loc + '/stdout.log'
+# the contents of bin_loc are removed at the start of every run, apart from
+# hidden files such as the source manifest
+src_man_loc = bin_loc + '/.source_manifest'
+# template setting up the psl environment, and the variables of it which are
+# passed to builds unless --full-env is used
+psl_template = '/psl/templates/psl.bash'
+psl_env_vars = ['CSCI', 'CSC', 'LEVEL', 'pdir', 'PSLPROJECT', 'PWD']
 # level prefixes used to format record output
 levelPrefix = ['   ', '│  ', '├─ ', '╰─ ']
 # psl terms, i.e. csci's, csc's, levels
@@ -86,6 +100,60 @@ class color:
     ERROR     = '\033[1;38;5;124m' # red bold
     ERR       = '\033[0;38;5;124m' # red
 
+    # line beginning with dash, hash, or at symbol
+    refs_rgx  = re.compile(r'(^\s*[-#@].*$)')
+    # rules applied in order to all other lines
+    rules = [
+        # word LOCAL
+        (re.compile('(LOCAL)'), CAP + r'\1' + END),
+        # line starting with WARNING
+        (re.compile('(^WARNING.*$)'), WARN + r'\1' + END),
+        # line containing error
+        (re.compile('(.*)(error)(.*$)', re.I),
+            ERR + r'\1' + ERROR + r'\2' + ERR + r'\3' + END),
+        # word following 'handle is:'
+        (re.compile('(handle is:\s)(.*$)'), r'\1' + HANDLE + r'\2' + END),
+        # word following BUILDING
+        (re.compile('(BUILDING\s+)(\w+)'), r'\1' + HANDLE + r'\2' + END),
+        # psl terms, local source files, build source files and build handles
+        None,
+        # using local files not in handles or local source
+        (re.compile('(Using Local\s+)(\w+)'), r'\1' + SRC + r'\2' + END),
+        # other library files
+        (re.compile('([\s/])(\w+\.([ax]|lib))'), r'\1' + LIB + r'\2' + END),
+        # fnl files
+        (re.compile('([\s/])(\w+\.fnl)'), r'\1' + FNL + r'\2' + END),
+        # build location path
+        (re.compile('(\S+SPARC_SOL/?)'), PATH + r'\1' + END)]
+    # color of each group of the terms regex
+    term_colors = {'src': SRC_B, 'file': SRC, 'hdl': HANDLE, 'psl': OTHER}
+    # compiled terms regex and the source and handle lists it was built from
+    terms_rgx = None
+    terms_key = None
+
+    @staticmethod
+    def compile_terms(sources, hdls):
+        """Compile psl terms, local source files, build source files and build
+        handles into one regex which colors them in a single scan of a line
+
+        """
+        alts = []
+        if sources:
+            alts.append(r'(?P<src>\b(?:%s)\b)' % '|'.join(
+                re.escape(x) for x in sorted(sources, key=len, reverse=True)))
+        alts.append('(?P<file>%s)' % '|'.join(
+            x.replace('(pp)', '(?:pp)') for x in source_file_rgx))
+        if hdls:
+            alts.append(r'(?P<hdl>\b(?:%s)(?:[cC][0-9]+)?(?!\.)\b)' % '|'.join(
+                re.escape(x) for x in sorted(hdls, key=len, reverse=True)))
+        alts.append(r'(?<=[^/])(?P<psl>\b(?:%s)(?!:)\b)' % '|'.join(
+            x.replace('(i)', '(?:i)') for x in psl_term_rgx))
+        return re.compile('|'.join(alts))
+
+    @staticmethod
+    def color_term(m):
+        return color.term_colors[m.lastgroup] + m.group(0) + color.END
+
     @staticmethod
     def addition(msg):
         """Add color to incoming string based on defined regex
@@ -94,59 +162,20 @@ class color:
         color.addition('any string')
 
         """
-        # color rgx: line beginning with dash, hash, or at symbol
-        rgx = r'(^\s*[-#@].*$)'
-        if re.search(rgx, msg):
-            msg = re.sub(rgx, color.REFS + r'\1' + color.END, msg)
-        else:
-            # color rgx: word LOCAL
-            rgx = '(LOCAL)'
-            msg = re.sub(rgx, color.CAP + r'\1' + color.END, msg)
-            # color rgx: line starting with WARNING
-            rgx = '(^WARNING.*$)'
-            msg = re.sub(rgx, color.WARN + r'\1' + color.END, msg)
-            # color rgx: line starting with ERROR
-            rgx = '(.*)((?i)error)(.*$)'
-            msg = re.sub(rgx, color.ERR + r'\1' + color.ERROR + r'\2' + 
-                    color.ERR + r'\3' + color.END, msg)
-            # color rgx: word following 'handle is:'
-            rgx = '(handle is:\s)(.*$)'
-            msg = re.sub(rgx, r'\1' + color.HANDLE + r'\2' + color.END, msg)
-            # color rgx: word following BUILDING
-            rgx = '(BUILDING\s+)(\w+)'
-            msg = re.sub(rgx, r'\1' + color.HANDLE + r'\2' + color.END, msg)
-            # color rgx: build source file
-            for psl in psl_term_rgx:
-            # for psl in psl_terms:
-                # rgx = r'([^/])\b(%s)\b' % psl
-                rgx = r'([^/])\b(%s)(?!:)\b' % psl
-                msg = re.sub(rgx, r'\1' + color.OTHER + r'\2' + color.END, msg)
-            # color rgx: local_source_files // slows as files increase
-            for src in local_source_files:
-                rgx = r'\b(%s)\b' % src
-                msg = re.sub(rgx, color.SRC_B + r'\1' + color.END, msg)
-            # # color rgx: build source file
-            for rgx in source_file_rgx:
-            # for src in local_source_files:
-                # rgx = r'\b(%s)\b' % src
-                msg = re.sub(rgx, color.SRC + r'\1' + color.END, msg)
-            # # color rgx: build handles
-            for hdl in handles:
-                rgx = r'\b(%s([cC][0-9]+)?(?!\.))\b' % hdl
-                # msg = re.sub(rgx, color.SRC_B + r'\1' + color.END, msg)
-                msg = re.sub(rgx, color.HANDLE + r'\1' + color.END, msg)
-            # color rgx: using local files not in handles or local source
-            rgx = '(Using Local\s+)(\w+)'
-            msg = re.sub(rgx, r'\1' + color.SRC + r'\2' + color.END, msg)
-            # color rgx: other library files
-            rgx = '([\s/])(\w+\.([ax]|lib))'
-            msg = re.sub(rgx, r'\1' + color.LIB + r'\2' + color.END, msg)
-            # color rgx: fnl files
-            rgx = '([\s/])(\w+\.fnl)'
-            msg = re.sub(rgx, r'\1' + color.FNL + r'\2' + color.END, msg)
-            # color rgx: build location path
-            rgx = '(\S+SPARC_SOL/?)'
-            msg = re.sub(rgx, color.PATH + r'\1' + color.END, msg)
+        if color.refs_rgx.search(msg):
+            return color.refs_rgx.sub(color.REFS + r'\1' + color.END, msg)
+
+        # rebuild the terms regex when the source or handle lists change
+        key = (id(local_source_files), len(local_source_files), id(handles), len(handles))
+        if key != color.terms_key:
+            color.terms_rgx = color.compile_terms(local_source_files, handles)
+            color.terms_key = key
+
+        for rule in color.rules:
+            if rule:
+                msg = rule[0].sub(rule[1], msg)
+            else:
+                msg = color.terms_rgx.sub(color.color_term, msg)
         return msg
 
 def relative_to_cwd(pth):
@@ -181,6 +210,102 @@ def path_to_path_relative_to_base(crnt, dest, base):
         raise PathError('one or more path does not contain the base directory: \ncrnt: %s\ndest: %s\nbase: %s\n' % (crnt, dest, base))
 
 
+class log_writer:
+
+    """Append lines to the log file through one open, buffered file handle
+
+    Lines are held until 'size' bytes are buffered or 'interval' seconds have
+    passed since the last write to the file, and are flushed at exit. While
+    lines are held a flusher thread writes them every 'interval' seconds, so
+    the log keeps up with a build which has gone quiet. Whole lines are written
+    under a lock, so concurrent build workers can share one log_writer.
+
+    """
+
+    def __init__(self, path, size=65536, interval=1.0):
+        self.path     = path
+        self.size     = size
+        self.interval = interval
+        self.file     = None
+        self.buf      = []
+        self.buf_len  = 0
+        self.last     = time.time()
+        self.lock     = threading.Lock()
+        self.flusher  = None   # flusher thread, started by the first write
+        self.stopped  = None   # event stopping the flusher thread
+        atexit.register(self.close)
+
+    def write(self, line):
+        self.lock.acquire()
+        try:
+            self.buf.append(line + '\n')
+            self.buf_len += len(line) + 1
+            if self.buf_len >= self.size or time.time() - self.last >= self.interval:
+                self._flush()
+            elif not self.flusher:
+                self.stopped = threading.Event()
+                self.flusher = threading.Thread(target=self._run, args=(self.stopped,))
+                self.flusher.daemon = True
+                self.flusher.start()
+        finally:
+            self.lock.release()
+
+    # flusher thread: write held lines every interval until stopped
+    def _run(self, stopped):
+        while not stopped.wait(self.interval):
+            self.lock.acquire()
+            try:
+                try:
+                    self._flush()
+                except IOError:
+                    pass
+            finally:
+                self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self._flush()
+        finally:
+            self.lock.release()
+
+    # write buffered lines to the log file. the file is opened on first use
+    def _flush(self):
+        self.last = time.time()
+        if not self.buf:
+            return
+        if not self.file:
+            self.file = open(self.path, 'a')
+        self.file.write(('').join(self.buf))
+        self.file.flush()
+        self.buf = []
+        self.buf_len = 0
+
+    def close(self):
+        """Flush and close the log file. it is reopened by the next write
+
+        """
+        # stop the flusher thread first, it takes the lock to flush
+        if self.flusher:
+            self.stopped.set()
+            self.flusher.join()
+            self.flusher = None
+        self.lock.acquire()
+        try:
+            try:
+                self._flush()
+            except IOError:
+                pass
+            if self.file:
+                self.file.close()
+                self.file = None
+        finally:
+            self.lock.release()
+
+# writer used by do_print for all log output
+log = log_writer(log_file)
+
+
 # all purpose print function. 
 # handles coloring, inline, and stderr prints
 def do_print(msg, **keywords):
@@ -207,45 +332,70 @@ def do_print(msg, **keywords):
     elif ('stderr' in keywords):
         # adds a new line if it isn't there
         if msg[-1] != '\n':
-            msg = ('').join(msg, '\n')
-            file.write('\n')
+            msg = msg + '\n'
         sys.stderr.write(msg)
 
     # use default print function
     else:
         if not color.log_only:
             print msg
-        file = open(log_file, 'a')
-        file.write(bmsg.rstrip() + '\n')
-        file.close()
-
-
+        log.write(bmsg.rstrip())
+
+# print node and its descendants one line at a time, as the tree is walked,
+# rather than building the whole drawing first
+def print_tree(node, options):
+    for line in node.lines(options.tree_depth, options.collapse):
+        do_print(line.rstrip('\n'))
+
+
+
+# return the environment set up by the psl template for csci, csc and level,
+# or None if the setup failed. the environment is cached until the template
+# changes, so bash is only started the first time
+def psl_environment(csci, csc, level, verbose=False):
+    # the environment is written by python with marshal, as values may hold
+    # newlines, e.g. exported functions, and env has no portable option for
+    # that. anything psl prints comes before the first NUL
+    dump = ('%s -c "import os, sys, marshal; '
+            'sys.stdout.write(marshal.dumps(dict(os.environ)))"' % pipes.quote(sys.executable))
+    cmd = ['bash', '-c', "source %s && psl %s %s %s && printf '\\0' && %s"
+            % (psl_template, csci, csc, level, dump)]
+    try:
+        mtime = os.stat(psl_template).st_mtime
+    except OSError:
+        mtime = None
+    key = caches.fingerprint('env', cmd, mtime, cwd)
+    cache = caches.result_cache(env_loc)
+
+    env = cache.get(key)
+    if env is not None:
+        if verbose:
+            do_print('# psl environment for %s %s %s read from "%s"'
+                    % (csci, csc, level, env_loc))
+        return env
+
+    if verbose:
+        do_print('# source psl.bash and call psl to set environment variables')
+        do_print('# \t$ %s' % (' ').join(cmd))
+    proc = Popen(cmd, stdout=PIPE)
+    out = proc.communicate()[0].split('\0', 1)
+    try:
+        env = marshal.loads(out[1])
+    except (IndexError, EOFError, ValueError, TypeError):
+        env = None
+    if proc.returncode != 0 or not isinstance(env, dict):
+        do_print('psl_build error: setting up the psl environment for %s %s %s failed with status %s'
+                % (csci, csc, level, proc.returncode))
+        return None
+    if mtime is not None:
+        cache.put(key, env)
+    return env
 
 # get parameter items from an fnl
 # e.g. HANDLE item
 def get_fnl_params(param, fnl):
-    found_param = False
-    f = open(fnl,'r')
-    # read in file one line at a time
-    for num, line in enumerate(f):
-        if not found_param:
-            if re.search(param, line):
-                found_param = True
-            continue
-        else:
-            # break loop if a line is found starting with '**'
-            if re.search('^\*\*', line):
-                break
-
-            # search for line starting with a file
-            m = re.search('^\s*(\w\S+)', line)
-            # if a match is found return it
-            if m: 
-                # print 'found result ', m.group(1), num
-                f.close()
-                return m.group(1), num + 1
-
-    f.close()
+    # fnl files are parsed once and cached by path and mtime
+    return fnls.get(fnl).get_param(param)
 
 
 
@@ -344,7 +494,92 @@ class progress:
         do_print(text, inline=True, stderr=True)
 
 
-def follow_files_tree(file_tree, location):
+class fetch_pool:
+
+    """Fetch fnl files with a bounded number of concurrent fetch processes
+
+    Failed fetches are retried. run() only returns once every fetch has
+    finished, so the fnl directory is complete before it is cataloged.
+
+    """
+
+    def __init__(self, fnl_dir, jobs=8, retries=2):
+        self.fnl_dir  = fnl_dir
+        self.jobs     = max(1, jobs)
+        self.retries  = retries
+        self.status   = {}   # fnl file -> exit status of its last fetch
+        self.attempts = {}   # fnl file -> number of fetches
+        self.latency  = []   # seconds taken by each fetch
+        self.lock     = threading.Lock()
+
+    def run(self, names, prog=None):
+        """Fetch all names and return the list of fnl files which failed
+
+        """
+        todo = Queue.Queue()
+        for name in names:
+            todo.put(name)
+        start = time.time()
+        workers = []
+        for i in range(min(self.jobs, len(names))):
+            t = threading.Thread(target=self._work, args=(todo, prog))
+            t.daemon = True
+            t.start()
+            workers.append(t)
+        # wait for every fetch to finish
+        for t in workers:
+            t.join()
+        elapsed = time.time() - start
+
+        failed = [name for name in names if self.status.get(name)]
+        for name in failed:
+            do_print('# psl_build error: fetch of %s failed with status %s after %d attempts'
+                    % (name, self.status[name], self.attempts[name]))
+        if self.latency:
+            do_print('# fetched %d/%d fnl files in %.2fs (%.1f/s), latency avg %.2fs max %.2fs, %d retries'
+                    % (len(names) - len(failed), len(names), elapsed,
+                       len(self.latency) / max(elapsed, 0.001),
+                       sum(self.latency) / len(self.latency), max(self.latency),
+                       len(self.latency) - len(names)))
+        return failed
+
+    # worker thread: fetch names from the queue until it is empty
+    def _work(self, todo, prog):
+        while True:
+            try:
+                name = todo.get_nowait()
+            except Queue.Empty:
+                return
+            for attempt in range(self.retries + 1):
+                t0 = time.time()
+                try:
+                    p = Popen(['fetch', name], stdout=PIPE, stderr=PIPE, cwd=self.fnl_dir)
+                    p.communicate()
+                    rtn = p.returncode
+                except OSError:
+                    # fetch could not be run. counted as a failed attempt
+                    rtn = -1
+                self.lock.acquire()
+                try:
+                    self.latency.append(time.time() - t0)
+                    self.status[name]   = rtn
+                    self.attempts[name] = attempt + 1
+                finally:
+                    self.lock.release()
+                if rtn == 0:
+                    break
+            self.lock.acquire()
+            try:
+                if prog:
+                    if rtn == 0:
+                        prog.increment(symbol='+')
+                    else:
+                        prog.increment(symbol='X')
+            finally:
+                self.lock.release()
+
+
+def follow_files_tree(file_tree, graph):
     new_files=[]
 
     fol_prog = progress('followed files')
@@ -352,43 +587,29 @@ def follow_files_tree(file_tree, location):
     # create a copy of the file tree to hold follow results
     follow_tree = tree.tree()
     follow = follow_tree.add_node('follow')
-    for x in file_tree.root.children:
-        follow.add_node(x.id)
-        new_files.append(x.id)
+    new_files = [x.id for x in file_tree.root.children]
+    follow_tree.extend(follow, new_files)
 
     # start processing with dictionary copy of flat library items
     fol_prog.size = follow.degree
 
-    # tmp = tempfile.NamedTemporaryFile()
-    fd, path = tempfile.mkstemp()
-
     while len(new_files):
-        # clear contents of temp file
-        tmp = open(path, 'wr+')
-        tmp.write(('\n').join(new_files))
-        tmp.close()
         num = len(new_files)
+        old_files = new_files
         new_files = []
 
-
-        cmd = ['/usr/bin/fgrep', '-f', path, location]
-        # cmd = ['/usr/bin/egrep', '-f', path, location]
-        p = Popen(cmd, stdout=PIPE, bufsize=1)
-        pat = r's/.*\/\(.*\):#include.*["<]\(.*\)[">]/\1:\2/'
-        cmd2= ['/usr/bin/sed', pat]
-        p2= Popen(cmd2, stdin=p.stdout,stdout=PIPE, bufsize=1)
-        for result in iter(p2.stdout.readline, ''):
-            # get file grep result
-            r = result.rstrip().split(':')
-            if len(r) == 2 and r[0] not in file_tree.nodes and r[1] in file_tree.nodes:
-                # follow.add_node(bname)
-                new_files.append(r[0])
-                file_tree.get_node(r[1]).add_node(r[0])
-                fol_prog.grow(symbol='+')
+        for inc in old_files:
+            added = []
+            for src in graph.get_includers(inc):
+                if not file_tree.has_node(src) and src not in added:
+                    added.append(src)
+                    fol_prog.grow(symbol='+')
+            # add the new includers of inc in one batch
+            if added:
+                new_files.extend(added)
+                file_tree.extend(file_tree.get_node(inc), added)
         fol_prog.increment(num, symbol='-')
 
-    os.remove(path)
-
     do_print('', inline=True, stderr=True)
 
 # def catalog_list(file_tree, location):
@@ -409,51 +630,36 @@ def catalog_list(file_tree, location, show_src=False):
     cat_prog = progress('resolved to fnl')
     cat_prog.size = len(file_tree.nodes) - 1
 
-    # tmp = tempfile.NamedTemporaryFile()
-    fd, path = tempfile.mkstemp()
+    # read every fnl file once into an index of listed names
+    fnl_idx = fnls.fnl_index(location)
 
     # create handles dictionary and function to coordinate handle id with filename
     handles = {}
     def get_handle_title(key):
         return '%s: %s' % (key, handles[key])
 
-    while len(new_files):
-        # clear contents of temp file
-        tmp = open(path, 'wr+')
-        tmp.write(('\n').join(new_files))
-        tmp.close()
+    # move a top level node under the fnl node. fnls which list each other
+    # would make a cycle, so the node is only added by name in that case
+    def adopt_or_add(f_node, s_node, s_name):
+        if (s_node.level == 1 and s_node.index != f_node.index
+                and not s_node.is_ancestor_of(f_node)):
+            f_node.adopt_subtree(s_node)
+        else:
+            f_node.add_node(s_name)
 
+    while len(new_files):
         # save new files for later use then clear out list
         old_files = new_files[:]
         new_files = []
 
-        # create chain of subprocess filters
-        # fgrep terms in tmp file over files in specified location
-        cmd1 = ['/usr/bin/fgrep']
-        cmd1.append('-nf')
-        cmd1.append(path)
-        cmd1.extend(glob.glob(location + '/*'))
-        p1 = Popen(cmd1, stdout=PIPE, bufsize=1)
-        # edit fgrep output to delete lines which don't match a specified 
-        #    regex pattern
-        cmd2 = ['/usr/bin/sed']
-        cmd2.append(r'/.*\/.*:[0-9][0-9]*: *\([a-zA-Z][a-zA-Z0-9_-\.]*\) *$/!d')
-        p2= Popen(cmd2, stdin=p1.stdout,stdout=PIPE, bufsize=1)
-        # edit sed output to capture three main components using regex, 
-        #    name of file term was found, linenum, and search term
-        cmd3 = ['/usr/bin/sed']
-        cmd3.append(r's/.*\/\(.*\):\([0-9][0-9]*\): *\([a-zA-Z][a-zA-Z0-9_-\.]*\).*$/\1:\2:\3/')
-        p3= Popen(cmd3, stdin=p2.stdout,stdout=PIPE, bufsize=1)
-        # process filter results
-        for result in p3.communicate()[0].splitlines():
-            # get file and line number from grep result
-            f_name, num, s_name = result.split(':')[:3]
-            if s_name not in old_files: 
-                continue
-
+        # process fnl entries of the new files, in fnl file then line order
+        for f_name, num, s_name in fnl_idx.find(old_files):
             # get handle and handle line number
-            hdl, h_num = get_fnl_params('HANDLE',location + '/' + f_name)
-            if (int(num) > int(h_num)):
+            hdr = fnl_idx.get_handle(f_name)
+            if hdr is None:
+                continue
+            hdl, h_num = hdr
+            if (num > h_num):
                 handles[hdl] = f_name
                 f_name = get_handle_title(hdl)
 
@@ -471,22 +677,22 @@ def catalog_list(file_tree, location, show_src=False):
                 try:
                     # get search-term node in tree
                     s_node = cat_tree.get_node(s_name)
-                    # move search-term node to child of fnl node
-                    if s_node.level == 1:
-                        f_node.adopt_subtree(s_node)
-                    else:
-                        f_node.add_node(s_name)
                 except:
+                    s_node = None
+                if s_node is not None:
+                    # move search-term node to child of fnl node
+                    adopt_or_add(f_node, s_node, s_name)
+                else:
                     # search-term node not in tree
                     try:
                         # get handle name in tree.
                         s_node = cat_tree.get_node(get_handle_title(s_name))
-                        # move search-term node to child of fnl node
-                        if s_node.level == 1:
-                            f_node.adopt_subtree(s_node)
-                        else:
-                            f_node.add_node(s_name)
                     except:
+                        s_node = None
+                    if s_node is not None:
+                        # move search-term node to child of fnl node
+                        adopt_or_add(f_node, s_node, s_name)
+                    else:
                         # neither search term or handle name is in tree
                         # add search-term node as child of fnl node
                         if show_src:
@@ -498,11 +704,350 @@ def catalog_list(file_tree, location, show_src=False):
         cat_prog.grow(len(new_files), symbol='+')
         cat_prog.shrink(len(old_files), symbol='-')
 
-    os.remove(path)
-
     do_print('', inline=True, stderr=True)
     return cat_tree, handles
 
+# catalog_list with its results kept in the catalog cache. the catalog only
+# depends on the names in file_tree, whether sources are shown and the fnl
+# files, so an unchanged set of sources and fnl files is not cataloged again
+def cached_catalog_list(file_tree, location, show_src=False, verbose=False):
+    names = sorted(set(x.id for x in file_tree.root.descendants))
+    key = caches.fingerprint('catalog', names, show_src,
+            fnls.fingerprint(location))
+    cache = caches.result_cache(cat_loc)
+
+    rec = cache.get(key)
+    if rec is not None:
+        data, handles = rec
+        if verbose:
+            do_print('# catalog of %d files read from "%s"' % (len(names), cat_loc))
+        return tree.tree.load(StringIO(data)), handles
+
+    cat_tree, handles = catalog_list(file_tree, location, show_src)
+    out = StringIO()
+    cat_tree.dump(out)
+    cache.put(key, (out.getvalue(), handles))
+    return cat_tree, handles
+
+
+
+# build a single fnl file with the psl build command. lines of build output are
+# passed to out. returns the build exit status and a dictionary of the binaries
+# produced by the build and their locations
+def build_fnl(x, handles, verbose=False, out=do_print):
+    binaries = {}
+    new_bin  = old_bin = None
+    suffix   = ''
+    out('\n\n# building fnl file: %s' % x)
+    if verbose:
+        cmd = ['/psl/bin/SPARC_SOL/build', '-Lv', x]
+    else:
+        cmd = ['/psl/bin/SPARC_SOL/build', '-L', x]
+    # cmd = ['build','-L', x]
+    if verbose:
+        out('# $ %s' % (' ').join(cmd))
+    p = Popen(cmd, stdout=PIPE, stderr=STDOUT, bufsize=1)
+    # for result in Popen(cmd, stdout = PIPE).stdout:
+    for lnn in iter(p.stdout.readline, ''):
+        out(lnn[:-1])
+        wds = lnn.split()
+        # find output line starting with 'BUILDING'
+        # if wds and wds[0] == 'USING' and wds[1] == 'FNL':
+            # fnl = wds[-1]
+        if wds and wds[0] == 'BUILDING':
+            # use contents of line to find binary and directory
+            new_bin = wds[1]
+            new_loc = wds[-1]
+            out(x)
+            out(new_bin)
+            root = re.sub('c[^c]+$','',new_bin)
+            out('root: %s' % root)
+            out('handle: %s' % handles[x])
+            # suffix = handles[x].split(root)[1]
+            hdl = handles[x].split('.')
+            if len(hdl) > 1:
+                suffix = '.' + hdl[-1]
+            else:
+                suffix = ''
+            out('suffix: %s' % suffix)
+            new_bin = new_bin + suffix
+            binaries[new_bin] = new_loc
+        if wds and len(wds) == 2 and wds[0] == '-':
+            # use contents of line to find binary and directory
+            out(wds)
+            old_bin = wds[1].split('.log')[0] + suffix
+            out(old_bin)
+        if len(wds) > 4  and (
+                (' ').join([wds[1],wds[2],wds[3],wds[4]]) == 'image up to date,'):
+            del binaries[new_bin]
+            binaries[old_bin] = new_loc
+            out('%s = %s' % (new_bin, old_bin))
+
+    return p.wait(), binaries
+
+
+class output_pipeline:
+
+    """Print and log output lines on a single consumer thread
+
+    Producers, e.g. the readers of build output, only queue lines, so slow
+    terminal output or colorizing can't keep a build from draining its pipe.
+    A group of lines is queued as one item and printed without interruption.
+
+    """
+
+    class group(list):
+        # lines printed together. any other item, even a list, is one line
+        pass
+
+    def __init__(self):
+        self.queue  = Queue.Queue()
+        self.thread = threading.Thread(target=self._consume)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, msg):
+        self.queue.put(msg)
+
+    def _consume(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, output_pipeline.group):
+                for msg in item:
+                    do_print(msg)
+            else:
+                do_print(item)
+
+    def close(self):
+        """Wait for all queued lines to be printed
+
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class build_scheduler:
+
+    """Build the fnl files of a catalog tree in dependency order
+
+    An fnl is only started after every fnl beneath it in the catalog tree has
+    built successfully, so independent branches of the tree are built
+    concurrently by up to 'jobs' workers. The output of each build is kept
+    together in the log and is printed by an output_pipeline. When a build
+    fails every fnl which depends on it is skipped. Fnls which depend on each
+    other are built in catalog order, leaves first.
+
+    With a build cache, each fnl is keyed by its handle, the contents of the
+    fnl file, the digests of the source files it lists and of the files they
+    include, and the keys of the fnls it depends on or whose handles it lists.
+    An fnl whose key was built before, and whose binaries are still those it
+    built, is not built again and its binaries are reused.
+
+    """
+
+    def __init__(self, b_tree, b_dict, jobs=1, verbose=False, cache=None,
+            fnl_dir='.', digests=None):
+        self.jobs     = max(1, jobs)
+        self.verbose  = verbose
+        self.cache    = cache    # caches.result_cache of builds, or None
+        self.fnl_dir  = fnl_dir
+        self.digests  = digests or {}   # source file name -> digests of it and its includes
+        self.keys     = {}   # fnl file -> build cache key
+        self.cached   = set()   # fnl files whose binaries came from the cache
+        self.order    = []   # fnl files, leaves first
+        self.deps     = {}   # fnl file -> set of fnl files built before it
+        self.handles  = {}   # fnl file -> handle
+        self.fnls     = b_dict   # handle -> fnl file
+        self.status   = {}   # fnl file -> 'built', 'cached', 'failed' or 'skipped'
+        self.binaries = {}
+        self.out      = do_print
+
+        remaining = dict(b_dict)
+        # loop through build subtrees
+        for child in b_tree.root.children:
+            # compile list of subtree nodes, leaves first
+            nodes = child.descendants
+            nodes.append(child)
+            for dep in nodes:
+                itm = dep.id.split(':')
+                handle = itm[0]
+                if len(itm) > 1:
+                    self.handles[itm[1].lstrip()] = handle
+                if handle in remaining:
+                    fnl = remaining.pop(handle)
+                    self.order.append(fnl)
+                    self.deps.setdefault(fnl, set())
+                fnl = b_dict.get(handle)
+                if not fnl:
+                    continue
+                # every fnl above this node depends on it. fnls listing each
+                # other depend on each other, and are built by run in order
+                anc = dep.parent
+                while anc:
+                    a_fnl = b_dict.get(anc.id.split(':')[0])
+                    if a_fnl and a_fnl != fnl:
+                        self.deps.setdefault(a_fnl, set()).add(fnl)
+                    anc = anc.parent
+
+    def run(self, prog=None):
+        """Build all fnl files and return a dictionary of the binaries built
+
+        """
+        done = Queue.Queue()
+        position = dict((fnl, ndx) for ndx, fnl in enumerate(self.order))
+        waiting = dict((fnl, set(self.deps[fnl])) for fnl in self.order)
+        dependents = {}
+        for fnl in self.order:
+            for dep in waiting[fnl]:
+                dependents.setdefault(dep, set()).add(fnl)
+
+        # all output is printed by a single consumer thread
+        pipeline = output_pipeline()
+        self.out = pipeline.put
+
+        ready = [fnl for fnl in self.order if not waiting[fnl]]
+        started = set(ready)
+        running = 0
+        while True:
+            if not ready and not running:
+                # anything left over depends on itself through the catalog
+                # tree, so build it in catalog order, leaves first
+                ready = [fnl for fnl in self.order if fnl not in started][:1]
+                if not ready:
+                    break
+                started.update(ready)
+            # start as many ready builds as there are free workers
+            while ready and running < self.jobs:
+                fnl = ready.pop(0)
+                if self.cache:
+                    # every fnl this fnl depends on is done, so their keys are known
+                    self.keys[fnl] = self._key(fnl)
+                t = threading.Thread(target=self._build, args=(fnl, done))
+                t.daemon = True
+                t.start()
+                running += 1
+
+            fnl, rtn, bins = done.get()
+            running -= 1
+            if prog: prog.increment(symbol='+')
+            if rtn == 0:
+                if fnl in self.cached:
+                    self.status[fnl] = 'cached'
+                else:
+                    self.status[fnl] = 'built'
+                    stats = self.keys.get(fnl) and self._stats(bins)
+                    if stats:
+                        self.cache.put(self.keys[fnl], (bins, stats))
+                self.binaries.update(bins)
+                for nxt in dependents.get(fnl, ()):
+                    waiting[nxt].discard(fnl)
+                    if not waiting[nxt] and nxt not in started:
+                        ready.append(nxt)
+                        started.add(nxt)
+                ready.sort(key=position.get)
+            else:
+                self.status[fnl] = 'failed'
+                self.out('# psl_build error: build of %s failed with status %s' % (fnl, rtn))
+                self._skip(fnl, dependents, started, prog)
+
+        if self.verbose:
+            self.out('# %d built, %d cached, %d failed, %d skipped' % tuple(
+                self.status.values().count(x)
+                for x in ('built', 'cached', 'failed', 'skipped')))
+        pipeline.close()
+        self.out = do_print
+        return self.binaries
+
+    # mark every fnl depending on a failed fnl as skipped
+    def _skip(self, failed, dependents, started, prog):
+        stack = list(dependents.get(failed, ()))
+        while stack:
+            fnl = stack.pop()
+            if fnl in started:
+                continue
+            started.add(fnl)
+            self.status[fnl] = 'skipped'
+            self.out('# skipping fnl file: %s (depends on %s)' % (fnl, failed))
+            if prog: prog.increment(symbol='X')
+            stack.extend(dependents.get(fnl, ()))
+
+    # return the build cache key of fnl, or None if the fnl file can't be read
+    # or an fnl it depends on, or whose handle it lists, has no key yet
+    def _key(self, fnl):
+        pth = os.path.join(self.fnl_dir, fnl)
+        try:
+            f = open(pth, 'rb')
+            try:
+                md5 = hashlib.md5(f.read()).hexdigest()
+            finally:
+                f.close()
+        except IOError:
+            return None
+        names   = sorted(set(name for name, num in fnls.get(pth).names))
+        sources = [(x, self.digests.get(x)) for x in names]
+        # the fnls of the handles listed, as well as those beneath fnl in the
+        # catalog tree
+        deps = set(self.deps[fnl])
+        deps.update(self.fnls[x] for x in names if x in self.fnls)
+        deps.discard(fnl)
+        deps = [(x, self.keys.get(x)) for x in sorted(deps)]
+        if [x for x, key in deps if not key]:
+            return None
+        env     = [os.environ.get(x) for x in ('CSCI', 'CSC', 'LEVEL')]
+        return caches.fingerprint('build', self.handles.get(fnl), md5,
+                sources, deps, env)
+
+    # return the mtime and size of each binary, or None if any of them is gone
+    def _stats(self, bins):
+        stats = {}
+        for name, loc in bins.iteritems():
+            try:
+                st = os.stat(os.path.join(loc, name))
+            except OSError:
+                return None
+            stats[name] = (st.st_mtime, st.st_size)
+        return stats
+
+    # return the binaries of a previous build of fnl, or None if there is none
+    # or any of its binaries is gone or has been rebuilt since
+    def _from_cache(self, fnl):
+        key = self.keys.get(fnl)
+        if not key:
+            return None
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        bins, stats = entry
+        if self._stats(bins) != stats:
+            return None
+        return bins
+
+    # worker thread: build one fnl and report the result back to run()
+    def _build(self, fnl, done):
+        if self.cache:
+            bins = self._from_cache(fnl)
+            if bins is not None:
+                self.cached.add(fnl)
+                self.out('\n\n# fnl file is up to date in the build cache: %s' % fnl)
+                done.put((fnl, 0, bins))
+                return
+        if self.jobs > 1:
+            # hold the output until the build is complete
+            lines = output_pipeline.group()
+            out = lines.append
+        else:
+            out = self.out
+        try:
+            rtn, bins = build_fnl(fnl, self.handles, self.verbose, out)
+        except Exception, e:
+            out('psl_build error: %s' % e)
+            rtn, bins = -1, {}
+        if self.jobs > 1:
+            self.out(lines)
+        done.put((fnl, rtn, bins))
+
 
 
 ##### not used in the script: adds too much time #######
@@ -585,6 +1130,28 @@ def main():
         default=False,
         help="show source files. used with -v and -l options")
 
+    parser.add_option(
+        "--changed",
+        action="store_true",
+        dest="changed",
+        default=False,
+        help='''only use the source files which changed since the last successful
+        build. the state of the sources is kept in "%s"''' % (src_man_loc))
+
+    parser.add_option(
+        "--tree-depth",
+        type="int",
+        dest="tree_depth",
+        default=None,
+        help="levels of a tree shown with -v and -l. deeper nodes are marked with '...'")
+
+    parser.add_option(
+        "--collapse",
+        action="store_true",
+        dest="collapse",
+        default=False,
+        help="show a subtree repeated in a tree only once. used with -v and -l options")
+
     parser.add_option(
         "-f", 
         "--follow",
@@ -593,6 +1160,16 @@ def main():
         default=False,
         help="follow local files, i.e. add all files including locals")
 
+    parser.add_option(
+        "-I", 
+        "--include-dir",
+        action="append",
+        dest="include_dirs",
+        default=[],
+        help='''directory searched for files including local files, used with -f.
+        may be given more than once. defaults to the current directory. the
+        include index is kept in "%s"''' % (inc_loc))
+
     help_read ='''read local fnl files from "%s" rather than fetching files and
     writing them to a temporary directory''' % (fnl_loc) 
 
@@ -610,7 +1187,8 @@ def main():
         action="store_true",
         dest="write",
         default=False,
-        help='fetch all fnl files to the local directory "%s"' % (fnl_loc))
+        help='''fetch fnl files to the local directory "%s". only fnl files which
+        are new or changed since the last fetch are fetched again''' % (fnl_loc))
 
     help_catalog_symbols ='''show symbols detailing the catalog process.
           %s'-' - remove source file, not found in fnl files.
@@ -627,8 +1205,72 @@ def main():
         default=False,
         help=help_catalog_symbols)
 
+    parser.add_option(
+        "--no-catalog-cache",
+        action="store_false",
+        dest="catalog_cache",
+        default=True,
+        help='''catalog source files even if the same files were cataloged against
+        the same fnl files before. catalogs are cached in "%s"''' % (cat_loc))
+
+    parser.add_option(
+        "--no-build-cache",
+        action="store_false",
+        dest="build_cache",
+        default=True,
+        help='''build every fnl file, even one whose fnl and source files are
+        unchanged since it was last built. builds are cached in "%s"''' % (bld_loc))
+
+    parser.add_option(
+        "--full-env",
+        action="store_true",
+        dest="full_env",
+        default=False,
+        help='''pass the whole environment set up by psl.bash to builds rather
+        than only %s. the environment is cached in "%s" until psl.bash
+        changes''' % (', '.join(psl_env_vars), env_loc))
+
+    parser.add_option(
+        "--log-buffer",
+        type="int",
+        dest="log_buffer",
+        default=65536,
+        help="bytes of output held before it is written to the log file. 0 writes every line")
+
+    parser.add_option(
+        "--scan-jobs",
+        type="int",
+        dest="scan_jobs",
+        default=8,
+        help="number of source directories read concurrently. 1 reads them one at a time")
+
+    parser.add_option(
+        "--fetch-jobs",
+        type="int",
+        dest="fetch_jobs",
+        default=8,
+        help="number of fnl files to fetch concurrently")
+
+    parser.add_option(
+        "--fetch-retries",
+        type="int",
+        dest="fetch_retries",
+        default=2,
+        help="number of times a failed fnl fetch is retried")
+
+    parser.add_option(
+        "-j", 
+        "--jobs",
+        type="int",
+        dest="jobs",
+        default=1,
+        help="number of fnl files to build concurrently. an fnl is only built "
+             "after all fnl files beneath it in the build tree")
+
     (options, args) = parser.parse_args()
 
+    log.size = options.log_buffer
+
 
     # define source progress bar
     if options.symbols:
@@ -647,7 +1289,9 @@ def main():
         cmd.extend(glob.glob(bin_loc + '/*'))
         if options.verb:
             do_print('\n# clearing contents of local binary directory: "%s"' % (" ".join(cmd)))
-        # remove previous links from local binary directory
+        # remove previous links from local binary directory. the log file is
+        # removed with them, so close it first
+        log.close()
         Popen(cmd).wait()
 
     
@@ -677,94 +1321,73 @@ def main():
         included_dirs  = 0
         total_dirs     = 0
 
-    # simple version for working with CWD
-
-    possible_files = 0
-    for entry in args:
-        if os.path.isfile(entry):
-            possible_files += 1
-        elif os.path.isdir(entry):
-            for (dirpath, dirs, filenames) in os.walk(entry):
-                possible_files += len(filenames)
-
-    if not possible_files:
-        print('no source files available to script\n')
-        parser.print_help()
-        sys.exit(1)
-
-
+    # walk the inputs once. the progress total grows as files are found and
+    # is kept one ahead of them until the walk is done
     src_prog = progress('files found')
-
-    src_prog.size = possible_files
-
-    # parse file or directory inputs
-    for entry in args:
-        # entry is a file
-        if os.path.isfile(entry):
-            # add files to set which do not match exclude_files
-            for i in exclude_files:
-                if not re.search(i, entry):
-                    # add file
-                    if options.verb:
-                        if options.src: src_prog.add_info('++ %s\n' % entry)
-                        included_files += 1
-                        total_files    += 1
-                    local_source_files.append(entry)
-                    src_prog.increment(symbol='+')
-                else:
-                    # remove file from possible files
-                    if options.verb:
-                        if options.src: src_prog.add_info('-- %s\n' % entry)
-                        total_files    += 1
-                    src_prog.shrink(symbol='-')
-        # entry is a directory
-        elif os.path.isdir(entry):
-            # walk recursively through the directory and get files
-            for (dirpath, dirs, filenames) in os.walk(entry):
-                if options.src and options.verb: do_print ('#    %s' % dirpath)
-                # remove excluded dirs
-                skip_dir = False
-                for i in exclude_dirs:
-                    if re.search(i, relative_to_cwd(dirpath)):
-                        # remove all files in directory from possible files
-                        skip_dir = True
-                        if options.verb:
-                            if options.src: src_prog.add_info('-- all files\n')
-                            total_dirs += 1
-                        src_prog.shrink(len(filenames),symbol='X')
-                        break
-                if skip_dir:
-                    continue
+    src_prog.size = 1
+    finder = sources.source_finder(exclude_dirs, exclude_files, cwd)
+    found = 0
+    source_paths = []   # path of each file in local_source_files
+    try:
+        for kind, name, pth in finder.walk(args, jobs=options.scan_jobs):
+            if kind == sources.FILE:
+                # add file
+                found += 1
+                if options.verb:
+                    if options.src: src_prog.add_info('++ %s\n' % name)
+                    included_files += 1
+                    total_files    += 1
+                local_source_files.append(name)
+                source_paths.append(pth)
+                src_prog.size += 1
+                src_prog.increment(symbol='+')
+            elif kind == sources.EXCLUDED_FILE:
+                # file matches the exclude set
+                found += 1
+                if options.verb:
+                    if options.src: src_prog.add_info('-- %s\n' % name)
+                    total_files    += 1
+                src_prog.increment(0, symbol='-')
+            elif kind == sources.DIR:
+                if options.src and options.verb: do_print ('#    %s' % pth)
                 if options.verb:
                     included_dirs += 1
                     total_dirs    += 1
+            else:
+                # excluded directory. it is not read
+                if options.verb:
+                    if options.src: src_prog.add_info('-- all files\n')
+                    total_dirs += 1
+                src_prog.increment(0, symbol='X')
+    # invalid entry
+    except OSError, e:
+        do_print('psl_build error: the local source file or directory does not exist')
+        do_print('\t%s' % os.path.abspath(e.filename))
+        sys.exit(1)
 
-                # add filenames not matching the exclude set
-                for filename in filenames:
-                    exclude_file = False
-                    for i in exclude_files:
-                        if re.search(i, filename): exclude_file = True
-
-                    if exclude_file:
-                        # remove file from possible files
-                        if options.verb:
-                            if options.src: src_prog.add_info('-- %s\n' % filename)
-                            total_files    += 1
-                        src_prog.shrink(symbol='-')
-                    else:
-                        # add file
-                        if options.verb:
-                            if options.src: src_prog.add_info('++ %s\n' % filename)
-                            included_files += 1
-                            total_files    += 1
-                        local_source_files.append(filename) 
-                        src_prog.increment(symbol='+')
-
-        # invalid entry
-        else: 
-            do_print('psl_build error: the local source file or directory does not exist')
-            do_print('\t%s' % os.path.abspath(entry))
-            sys.exit(1)
+    if not found:
+        print('no source files available to script\n')
+        parser.print_help()
+        sys.exit(1)
+    if local_source_files:
+        src_prog.shrink(symbol='+')
+
+    # record the state of the source files. it is saved after a successful
+    # build, and with --changed only the files changed since then are used
+    src_manifest = None
+    if options.changed or not options.list:
+        src_manifest = sources.source_manifest(src_man_loc)
+        changed = set(src_manifest.update(source_paths))
+    if options.changed:
+        changed_files = [name for name, pth in zip(local_source_files, source_paths)
+                if os.path.abspath(pth) in changed]
+        if options.verb:
+            do_print('# %d of %d source files changed since the last successful build'
+                    % (len(changed_files), len(local_source_files)))
+        if not changed_files:
+            do_print('# no source files changed since the last successful build')
+            sys.exit(0)
+        local_source_files[:] = changed_files
 
     if options.verb:
         do_print('# processing %d/%d files from %d/%d directories' 
@@ -774,16 +1397,23 @@ def main():
     top = src_tree.add_node('top')
 
     # add local source files to library
-    for src in local_source_files:
-        top.add_node(src)
+    src_tree.extend(top, local_source_files)
 
     # determine what build files include the local source files
-    # NOTE: currently the 'all_includes' files represents build 270
     if options.follow:
-        follow_files_tree(src_tree, '/export/home/jquisenberry/builds/tst_cord/all_includes')
+        if not options.include_dirs:
+            options.include_dirs.append(os.getcwd())
+        # update the include index from files changed since the last run
+        inc_index = includes.include_index(inc_loc)
+        parsed, removed = inc_index.refresh(options.include_dirs, exclude_dirs)
+        inc_index.save()
+        if options.verb:
+            do_print('# include index %s: %d files, %d parsed, %d removed'
+                    % (inc_loc, len(inc_index.files), parsed, removed))
+        follow_files_tree(src_tree, inc_index)
 
     if options.verb:
-        if options.src: do_print(src_tree)
+        if options.src: print_tree(src_tree.root, options)
 
 
     ################################################################################
@@ -795,7 +1425,7 @@ def main():
             cmd = ['mkdir', fnl_loc]
             if options.verb:
                 do_print('\n# making local directory: "%s"' % (" ".join(cmd)))
-            Popen(cmd)
+            Popen(cmd).wait()
         fnl_dir = fnl_loc
         # read option is not necessary
         if options.read: options.read = False
@@ -838,16 +1468,54 @@ def main():
         fetch_prog = progress('fetched fnls')
 
 
-        # get fnl files and put them in temp dir
-        pg = Popen(['progress'], stdout=PIPE).stdout.readlines()
-        fetch_prog.size = len(pg)
+        # get fnl files and put them in temp dir. the progress line of each
+        # fnl is used as its upstream version
+        try:
+            proc = Popen(['progress'], stdout=PIPE)
+            pg = proc.stdout.readlines()
+            rtn = proc.wait()
+        except OSError, e:
+            pg, rtn = [], e
+        if rtn:
+            do_print('psl_build error: listing fnl files with progress failed: %s' % rtn)
+            sys.exit(1)
+        names = []
+        versions = {}
         for ndx, lnnn in enumerate(pg):
             nodess = re.search(r'([a-zA-Z][a-zA-Z0-9_-]*\.fnl)', lnnn)
-            if nodess:
-                fetch_prog.increment(symbol='+')
-                Popen(['fetch', str(nodess.group(1))], stderr=PIPE, cwd=fnl_dir)
-            else:
-                fetch_prog.shrink(symbol='-')
+            if nodess and str(nodess.group(1)) not in versions:
+                names.append(str(nodess.group(1)))
+                versions[names[-1]] = lnnn.strip()
+        # without a listing every fnl would look gone upstream, and be pruned
+        # from the local fnl mirror
+        if not versions:
+            do_print('psl_build error: progress listed no fnl files')
+            sys.exit(1)
+        fetch_prog.size = len(names)
+
+        # only fetch new or changed fnl files into the local fnl mirror
+        if options.write:
+            manifest = fnls.fnl_manifest(fnl_dir)
+            for name in manifest.entries.keys():
+                if name not in versions:
+                    manifest.discard(name)
+            current = set(x for x in names if manifest.is_current(x, versions[x]))
+            if current:
+                fetch_prog.increment(len(current), symbol='=')
+            names = [x for x in names if x not in current]
+            if options.verb:
+                do_print('# %d fnl files up to date in %s, %d to fetch'
+                        % (len(current), os.path.abspath(fnl_dir), len(names)))
+
+        # returns once all fetches have finished
+        pool = fetch_pool(fnl_dir, jobs=options.fetch_jobs, retries=options.fetch_retries)
+        failed = pool.run(names, fetch_prog)
+
+        if options.write:
+            for name in set(names).difference(failed):
+                if os.path.isfile(os.path.join(fnl_dir, name)):
+                    manifest.record(name, versions[name])
+            manifest.save()
 
 
     if options.verb:
@@ -855,55 +1523,51 @@ def main():
 
     # get tree and dictionary of fnl files affected by the files in the source tree
     # b_tree, b_dict = catalog_list(src_tree, fnl_dir)
-    b_tree, b_dict = catalog_list(src_tree, fnl_dir, show_src=options.src)
+    if options.catalog_cache:
+        b_tree, b_dict = cached_catalog_list(src_tree, fnl_dir,
+                show_src=options.src, verbose=options.verb)
+    else:
+        b_tree, b_dict = catalog_list(src_tree, fnl_dir, show_src=options.src)
     print b_dict
-    handles = {}
+    # color build handles in the output
+    handles.extend(b_dict.keys())
 
-    # loop through build subtrees
-    for child in b_tree.root.children:
-        if options.verb or options.list or options.log_only:
-            # show local fnl build trees
+    # show local fnl build trees
+    if options.verb or options.list or options.log_only:
+        for child in b_tree.root.children:
             do_print('# %s, local build fnl tree:' % child.id.split(':')[0])
-            do_print(child)
-        if not options.list:
-            # compile list of subtree nodes, leaves first
-            nodes = child.descendants
-            nodes.append(child)
-            # loop through all nodes of build subtrees
-            for dep in nodes:
-                itm = dep.id.split(':')
-                # handle = dep.id.split(':')[0]
-                handle = itm[0]
-                if len(itm) > 1:
-                    handles[itm[1].lstrip()] = handle
-                try:
-                    build_files.append(b_dict.pop(handle))
-                except KeyError:
-                    pass
-
+            print_tree(child, options)
 
     if not options.list:
+        # order fnl files, leaves first, and resolve build dependencies
+        build_cache = None
+        digests = None
+        if options.build_cache:
+            build_cache = caches.result_cache(bld_loc)
+            # digests of the local source files, and of the files in the
+            # include index, covering the files they include
+            digests = sources.source_digests(source_paths, src_manifest,
+                    inc_index if options.follow else None)
+        scheduler = build_scheduler(b_tree, b_dict, jobs=options.jobs,
+                verbose=options.verb, cache=build_cache, fnl_dir=fnl_dir,
+                digests=digests)
+        build_files.extend(scheduler.order)
 
         # Source psl template and set environment variables
-        cmd = ['bash', '-c',
-            'source /psl/templates/psl.bash && psl site_lrr-1 csc00 int && env']
-        proc = Popen(cmd, stdout=PIPE, bufsize=1)
-        if options.verb:
-            do_print('# source psl.bash and call psl to set environment variables')
-            do_print('# \t$ %s' % (' ').join(cmd))
-        # for line in proc.stdout:
-        for line in iter(proc.stdout.readline, ''):
-            rsl = line[:-1].split('=')
-            if len(rsl) == 2 and (
-                rsl[0] == 'CSCI' or
-                rsl[0] == 'CSC' or
-                rsl[0] == 'LEVEL' or
-                rsl[0] == 'pdir' or
-                rsl[0] == 'PSLPROJECT' or
-                rsl[0] == 'PWD'):
-                if options.verb:
-                    do_print('# \t%s' % line[:-1])
-                os.environ[rsl[0]] = rsl[1]
+        env = psl_environment('site_lrr-1', 'csc00', 'int', options.verb)
+        if env is None:
+            sys.exit(1)
+        if options.full_env:
+            # builds run with the whole psl environment
+            os.environ.update(env)
+            if options.verb:
+                do_print('# \tset %d environment variables' % len(env))
+        else:
+            for name in psl_env_vars:
+                if name in env:
+                    if options.verb:
+                        do_print('# \t%s=%s' % (name, env[name]))
+                    os.environ[name] = env[name]
 
         ############################################################################
         # build all necessary fnl files
@@ -911,61 +1575,13 @@ def main():
         # define fetch progress bar
         build_prog = progress('build files')
         build_prog.size = len(build_files)
-        binaries = {}
-        # loop through build files and build
-        for x in build_files:
-            do_print('\n\n# building fnl file: %s' % x)
-            if options.verb:
-                cmd = ['/psl/bin/SPARC_SOL/build', '-Lv', x]
-            else:
-                cmd = ['/psl/bin/SPARC_SOL/build', '-L', x]
-            # cmd = ['build','-L', x]
-            if options.verb:
-                do_print('# $ %s' % (' ').join(cmd))
-            p = Popen(cmd, stdout=PIPE, stderr=STDOUT, bufsize=1)
-            # for result in Popen(cmd, stdout = PIPE).stdout:
-            for lnn in iter(p.stdout.readline, ''):
-                do_print(lnn[:-1])
-                wds = lnn.split()
-                # find output line starting with 'BUILDING'
-                # if wds and wds[0] == 'USING' and wds[1] == 'FNL':
-                    # fnl = wds[-1]
-                if wds and wds[0] == 'BUILDING':
-                    # use contents of line to find binary and directory
-                    new_bin = wds[1]
-                    new_loc = wds[-1]
-                    # binaries[new_bin] = new_loc
-                    # print wds, b_dict
-                    # for key, val in handles.iteritems():
-                        # print key, val, ':', x
-                        # if val == x:
-                    print x
-                    print new_bin
-                    root = re.sub('c[^c]+$','',new_bin)
-                    print 'root:', root
-                    print 'handle:', handles[x]
-                    # suffix = handles[x].split(root)[1]
-                    hdl = handles[x].split('.')
-                    if len(hdl) > 1:
-                        suffix = '.' + hdl[-1]
-                    else:
-                        suffix = ''
-                    print 'suffix:', suffix
-                    new_bin = new_bin + suffix
-                    binaries[new_bin] = new_loc
-                if wds and len(wds) == 2 and wds[0] == '-':
-                    # use contents of line to find binary and directory
-                    print wds
-                    old_bin = wds[1].split('.log')[0] + suffix
-                    print old_bin
-                if len(wds) > 4  and (
-                        (' ').join([wds[1],wds[2],wds[3],wds[4]]) == 'image up to date,'):
-                    del binaries[new_bin]
-                    binaries[old_bin] = new_loc
-                    print new_bin, '=', old_bin
-
-            # build_prog.add_info(': %s' % x)
-            build_prog.increment(symbol='+')
+        if options.verb:
+            do_print('# building %d fnl files with %d jobs' % (len(build_files), options.jobs))
+        binaries = scheduler.run(build_prog)
+
+        # the next --changed run starts from the sources of this build
+        if not [x for x in scheduler.status.values() if x not in ('built', 'cached')]:
+            src_manifest.save()
 
 
         for key, val in binaries.iteritems():
@@ -0,0 +1,382 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Discovery of local source files
+
+The files and directories given to psl_build are walked once. Excluded
+directories are pruned before they are read, and names are tested against one
+combined regular expression per exclude set. Entries are yielded as they are
+found, so the caller can count and show them while the walk goes on.
+
+Directories are read with scandir where it is available, i.e. os.scandir or
+the scandir package, which tells files from directories without a stat of
+every entry. Otherwise os.listdir and a stat per entry are used.
+
+On a network file system each directory read is a round trip. A walk can
+use a crawler whose threads read directories ahead of it, keeping several
+reads in flight, while the walk still yields entries in the same order.
+
+The mtime, size and md5 of the source files of the last successful build are
+kept in a manifest, so that a build can be limited to the files which changed
+since then. The digest of a source file can also cover every local file it
+includes, so that a change to a header is seen in the files including it.
+
+"""
+import os, re, errno, threading, Queue, marshal, hashlib
+import includes
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# kinds of entries yielded by source_finder.walk
+FILE, DIR, EXCLUDED_FILE, EXCLUDED_DIR = range(4)
+
+def combine(patterns):
+    # return one regex matching any of patterns, or None if there are none
+    patterns = list(patterns)
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % x for x in patterns))
+
+def list_dir(pth):
+    """Return lists of the names of files and of directories in pth
+
+    as with os.walk, symbolic links to directories are not descended into, and
+    an unreadable directory is empty
+
+    """
+    files = []
+    dirs  = []
+    try:
+        if scandir is not None:
+            for entry in scandir(pth):
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.name)
+                elif not entry.is_symlink():
+                    dirs.append(entry.name)
+        else:
+            for name in os.listdir(pth):
+                full = os.path.join(pth, name)
+                if not os.path.isdir(full):
+                    files.append(name)
+                elif not os.path.islink(full):
+                    dirs.append(name)
+    except OSError:
+        return [], []
+    return files, dirs
+
+
+class _listing(object):
+
+    """Files and subdirectories of a directory, read by a crawler thread
+
+    """
+
+    def __init__(self, pth):
+        self.path  = pth
+        self.files = []
+        self.subs  = []   # list of (path, listing or None if excluded)
+        self.done  = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        return self.files, self.subs
+
+
+class dir_crawler(object):
+
+    """Threads reading directories ahead of a walk
+
+    When a directory has been read, its subdirectories which are not excluded
+    are queued to be read too. The queue is last in, first out, and the first
+    subdirectory is queued last, so reads run ahead of the walk in its order
+
+    """
+
+    def __init__(self, finder, jobs=8):
+        self.finder  = finder
+        self.queue   = Queue.LifoQueue()
+        self.stopped = False
+        self.threads = []
+        for i in range(jobs):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def read(self, pth):
+        # queue pth to be read and return its listing
+        lst = _listing(pth)
+        self.queue.put(lst)
+        return lst
+
+    def close(self):
+        # stop the threads. directories still queued are not read
+        self.stopped = True
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+    def _run(self):
+        while True:
+            lst = self.queue.get()
+            if lst is None:
+                return
+            try:
+                if self.stopped:
+                    continue
+                files, dirs = list_dir(lst.path)
+                subs = []
+                for name in dirs:
+                    pth = os.path.join(lst.path, name)
+                    if self.finder.is_excluded_dir(pth):
+                        subs.append((pth, None))
+                    else:
+                        subs.append((pth, _listing(pth)))
+                for pth, sub in reversed(subs):
+                    if sub:
+                        self.queue.put(sub)
+                lst.files = files
+                lst.subs  = subs
+            finally:
+                lst.done.set()
+
+
+class source_finder(object):
+
+    """Walk of source files and directories with exclude patterns
+
+    Directory patterns are matched against the path of a directory relative to
+    base, file patterns against the name of a file
+
+    """
+
+    def __init__(self, exclude_dirs=(), exclude_files=(), base=None):
+        self.exclude_dir  = combine(exclude_dirs)
+        self.exclude_file = combine(exclude_files)
+        self.base = base or os.getcwd()
+
+    def is_excluded_dir(self, pth):
+        if self.exclude_dir is None:
+            return False
+        if pth.startswith(self.base):
+            pth = '.' + pth[len(self.base):]
+        return bool(self.exclude_dir.search(pth))
+
+    def is_excluded_file(self, name):
+        return self.exclude_file is not None and bool(self.exclude_file.search(name))
+
+    def walk(self, entries, jobs=1):
+        """Generate (kind, name, path) for each file and directory found
+
+        A file entry is yielded as given. Directory entries are walked top down
+        in the order of os.walk. The files of a directory are yielded after it,
+        then its subdirectories. An excluded directory is yielded but not read.
+        With more than one job, directories are read ahead by that many
+        threads. OSError is raised for an entry which does not exist
+
+        """
+        crawler = None
+        if jobs > 1:
+            crawler = dir_crawler(self, jobs)
+        try:
+            for entry in entries:
+                if os.path.isfile(entry):
+                    if self.is_excluded_file(entry):
+                        yield EXCLUDED_FILE, entry, entry
+                    else:
+                        yield FILE, entry, entry
+                elif os.path.isdir(entry):
+                    for rec in self._walk_dir(entry, crawler):
+                        yield rec
+                else:
+                    raise OSError(errno.ENOENT, 'no such file or directory', entry)
+        finally:
+            if crawler:
+                crawler.close()
+
+    def _walk_dir(self, top, crawler=None):
+        # stack of (directory, its listing if it is being read by crawler)
+        if crawler and not self.is_excluded_dir(top):
+            stack = [(top, crawler.read(top))]
+        else:
+            stack = [(top, None)]
+        while stack:
+            dirpath, lst = stack.pop()
+            if self.is_excluded_dir(dirpath):
+                yield EXCLUDED_DIR, os.path.basename(dirpath), dirpath
+                continue
+            yield DIR, os.path.basename(dirpath), dirpath
+            if lst:
+                files, subs = lst.wait()
+            else:
+                files, dirs = list_dir(dirpath)
+                subs = [(os.path.join(dirpath, x), None) for x in dirs]
+            for name in files:
+                if self.is_excluded_file(name):
+                    yield EXCLUDED_FILE, name, os.path.join(dirpath, name)
+                else:
+                    yield FILE, name, os.path.join(dirpath, name)
+            stack.extend(reversed(subs))
+
+
+class source_manifest(object):
+
+    """mtime, size and md5 of each source file at the last successful build
+
+    """
+    version = 1
+
+    def __init__(self, location):
+        self.location = location
+        self.entries  = {}   # absolute path -> (mtime, size, md5)
+        self.current  = {}   # entries to save, updated by update
+        try:
+            f = open(self.location, 'rb')
+            try:
+                version, entries = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            # missing or unreadable manifest. every file has changed
+            pass
+        else:
+            if version == source_manifest.version:
+                self.entries = entries
+        self.current = dict(self.entries)
+
+    def update(self, paths):
+        """Record the current state of paths and return the paths whose
+        contents differ from the saved manifest, or which are not in it
+
+        files are only read for their md5 if their mtime or size changed
+
+        """
+        changed = []
+        for pth in paths:
+            pth = os.path.abspath(pth)
+            try:
+                st = os.stat(pth)
+            except OSError:
+                continue
+            rec = self.entries.get(pth)
+            if rec and rec[0] == st.st_mtime and rec[1] == st.st_size:
+                self.current[pth] = rec
+                continue
+            f = open(pth, 'rb')
+            try:
+                md5 = hashlib.md5(f.read()).hexdigest()
+            finally:
+                f.close()
+            self.current[pth] = (st.st_mtime, st.st_size, md5)
+            if not rec or rec[2] != md5:
+                changed.append(pth)
+        return changed
+
+    def save(self):
+        # save the state recorded by update, e.g. after a successful build
+        tmp = self.location + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            marshal.dump((source_manifest.version, self.current), f)
+        finally:
+            f.close()
+        os.rename(tmp, self.location)
+        self.entries = dict(self.current)
+
+
+class source_digests(object):
+
+    """Digests of source files by name, covering the files they include
+
+    The digest of a name lists the md5 of each file of that name and of every
+    file it includes, directly or not, which the run can read. Includes are
+    looked up beside the including file, then among the files by name. Files
+    in the manifest are digested by their md5, files in the include index by
+    their indexed mtime and size, and other files by their md5
+
+    """
+
+    def __init__(self, paths, manifest=None, inc_index=None):
+        self.manifest  = manifest
+        self.inc_index = inc_index
+        self.paths     = {}   # file name -> list of absolute paths
+        self.digests   = {}   # file name -> digest, filled in by get
+        self.files     = {}   # absolute path -> digest
+        self.includes  = {}   # absolute path -> list of included absolute paths
+        self.indexed   = {}   # absolute path -> include index record
+        if inc_index:
+            for pth, rec in inc_index.files.iteritems():
+                self.indexed[os.path.abspath(pth)] = rec
+        for pth in list(paths) + list(self.indexed):
+            pth = os.path.abspath(pth)
+            lst = self.paths.setdefault(os.path.basename(pth), [])
+            if pth not in lst:
+                lst.append(pth)
+
+    def get(self, name, default=None):
+        """Return a sorted list of (path, digest) of the files named name and
+        the files they include, or default if the run has no file of that name
+
+        """
+        if name not in self.paths:
+            return default
+        if name not in self.digests:
+            seen  = set()
+            stack = list(self.paths[name])
+            while stack:
+                pth = stack.pop()
+                if pth in seen:
+                    continue
+                seen.add(pth)
+                stack.extend(self._includes(pth))
+            self.digests[name] = sorted((x, self._digest(x)) for x in seen)
+        return self.digests[name]
+
+    # return the absolute paths of the readable files included by pth
+    def _includes(self, pth):
+        if pth not in self.includes:
+            rec = self.indexed.get(pth)
+            if rec:
+                incs = rec[2]
+            else:
+                incs = includes.include_index.parse(pth)
+            found = []
+            for inc in incs:
+                near = os.path.join(os.path.dirname(pth), inc)
+                if os.path.isfile(near):
+                    found.append(os.path.abspath(near))
+                else:
+                    found.extend(self.paths.get(os.path.basename(inc), ()))
+            self.includes[pth] = found
+        return self.includes[pth]
+
+    # return the digest of the file at pth, or None if it can't be read
+    def _digest(self, pth):
+        if pth not in self.files:
+            rec = self.manifest and self.manifest.current.get(pth)
+            if rec:
+                self.files[pth] = rec[2]
+                return self.files[pth]
+            rec = self.indexed.get(pth)
+            if rec:
+                self.files[pth] = rec[:2]
+                return self.files[pth]
+            try:
+                f = open(pth, 'rb')
+                try:
+                    self.files[pth] = hashlib.md5(f.read()).hexdigest()
+                finally:
+                    f.close()
+            except IOError:
+                self.files[pth] = None
+        return self.files[pth]
@@ -1,13 +1,28 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-import weakref, gc, pprint
+import weakref, gc, pprint, itertools, collections, marshal
+from cStringIO import StringIO
 
 class tree(object):
 
-
-    def __init__(self):
-        self.nodes = {}
-        self.orphans = {}
+    # raised when a node would become its own ancestor
+    class CycleError(Exception):
+        pass
+
+    # version of the file format written by dump
+    dump_version = 1
+
+    # nodes are keyed by their index, a unique integer. any number of nodes
+    # can share an id; names maps each id to the keys of its nodes
+    # node_class is the class used for the nodes of the tree, _node by default
+    def __init__(self, node_class=None):
+        self.nodes = {}     # key -> node, for nodes in the tree
+        self.orphans = {}   # key -> node, for nodes not yet adopted
+        self.names = {}     # id -> key(s) of nodes with that id
+        self.kids = {}      # (parent key, id) -> key(s) of child nodes
+        self.node_class = node_class or _node
+        # single weak reference to the tree shared by all of its nodes
+        self._proxy = weakref.proxy(self)
 
     @property
     def root(self):
@@ -24,22 +39,16 @@ class tree(object):
     # add a node to tree. adds as child of root if parent is not 
     # specified. a weak reference to the new node is returned
     # def add_node(self, *args, **kwargs):
-    # add node to orphanage unless parent is specified
+    # add node to orphanage unless parent is specified. parent is a node or
+    # the id of a node
     def add_node(self, id, **kwargs):
-        # don't add a node with the same id as one that already exists in tree
-        while id in self.nodes:
-            id = id + '.'
-        # if id in self.nodes:
-            # id = id + '@'
-            # print id
-            # raise Exception('node id already in tree')
-            # return
-        nd = _node(id, self)
+        nd = self.node_class(id, self)
+        _add_key(self.names, id, nd.index)
         if 'parent' in kwargs:
-            p_node = self.get_node(kwargs['parent'])
+            p_node = self._resolve(kwargs['parent'])
             p_node.adopt(nd)
         if not self.nodes:
-            self.nodes[nd.id] = self.orphans.pop(nd.__repr__(), None)
+            self.nodes[nd.index] = self.orphans.pop(nd.index, None)
 
         return nd
 
@@ -47,9 +56,8 @@ class tree(object):
         if self.root:
             old_root = self.root
             nd = self.add_node(id)
-            self.root.parent = nd
-            self.nodes[nd.id] = self.orphans.pop(nd.__repr__(), None)
-            nd.children.append(old_root)
+            self.nodes[nd.index] = self.orphans.pop(nd.index, None)
+            nd._link(old_root)
         else:
             nd = self.add_node(id)
         return nd
@@ -61,15 +69,15 @@ class tree(object):
     # as parent of root. a weak reference to the new node is returned
     def insert_node(self, id, **kwargs):
         if 'before' in kwargs:
-            p_node = self.get_node(kwargs['before'])
+            p_node = self._resolve(kwargs['before'])
             if p_node.is_root:
-                self.add_root_node(id)
+                nd = self.add_root_node(id)
             else:
                 nd = self.add_node(id)
                 p_node.parent.adopt(nd)
                 nd.adopt_subtree(p_node)
         elif 'after' in kwargs:
-            p_node = self.get_node(kwargs['after'])
+            p_node = self._resolve(kwargs['after'])
             kids = p_node.children[:]
             nd = self.add_node(id)
             p_node.adopt(nd)
@@ -84,20 +92,126 @@ class tree(object):
     # delete a node, or nodes, in the tree. node must be a leaf, i.e. has no children
     def delete_node(self, *args):
         for id in args:
-            self.get_node(id).delete()
+            self._resolve(id).delete()
 
     # delete a subtree, i.e. the node and all descendants
     def delete_subtree(self, *args):
         for id in args:
-            lst = self.get_node(id).list_subtree_ids()
-            for sub_id in lst:
-                print sub_id
-                self.delete_node(sub_id)
+            self._resolve(id).delete_subtree()
+
+    # add a child node to parent for each id. the nodes are linked in one pass
+    # and heights are updated once. a list of weak references to the new nodes
+    # is returned
+    def extend(self, parent, ids):
+        p_node = self._resolve(parent)
+        rtn = []
+        for id in ids:
+            nd = p_node._append(self._new_node(id))
+            nd._place(p_node)
+            rtn.append(nd)
+        if rtn:
+            p_node._raise_height(1, len(rtn))
+        return rtn
+
+    # build a tree from an iterable of (parent id, child id) pairs. each id is
+    # one node, so an id may only be the child of one parent, and all nodes
+    # must descend from a single root. the tree is built top down in one pass,
+    # without the cycle check of add_child. edges which go round a cycle raise
+    # tree.CycleError
+    @classmethod
+    def from_edges(cls, edges, node_class=None):
+        t = cls(node_class)
+        parents  = {}   # child id -> parent id
+        children = {}   # parent id -> list of child ids, in edge order
+        ids = []        # ids in the order they are first seen
+        for p_id, c_id in edges:
+            if p_id == c_id:
+                raise tree.CycleError('node (%s) is its own parent' % c_id)
+            if c_id in parents:
+                raise Exception('node (%s) has more than one parent' % c_id)
+            if p_id not in parents and p_id not in children:
+                ids.append(p_id)
+            if c_id not in children:
+                ids.append(c_id)
+            parents[c_id] = p_id
+            children.setdefault(p_id, []).append(c_id)
+        if not ids:
+            return t
+
+        roots = [x for x in ids if x not in parents]
+        # every node has a parent only if the edges go round a cycle
+        if not roots:
+            raise tree.CycleError('edges contain a cycle')
+        if len(roots) != 1:
+            raise Exception('edges must form one tree, found %d roots' % len(roots))
+
+        # link nodes level by level from the root
+        nodes = [t.add_node(roots[0])]
+        for p_node in nodes:
+            for c_id in children.get(p_node.id, ()):
+                nd = p_node._append(t._new_node(c_id))
+                nd._place(p_node)
+                nodes.append(nd)
+        # nodes on a cycle can't be reached from the root
+        if len(nodes) != len(ids):
+            raise tree.CycleError('edges contain a cycle')
+
+        _set_heights(nodes)
+        return t
+
+    # write the tree to the open file fp. the file holds the node ids in
+    # preorder and, for each node, the preorder position of its parent or -1.
+    # the root comes first, followed by any orphans and their descendants
+    def dump(self, fp):
+        ids     = []
+        parents = []
+        pos     = {}   # node key -> preorder position
+        tops = [self.root] if self.root else []
+        tops.extend(self.orphans[k]._weak() for k in sorted(self.orphans))
+        for top in tops:
+            for nd in top.preorder():
+                pos[nd.index] = len(ids)
+                ids.append(nd.id)
+                if nd.index == top.index:
+                    parents.append(-1)
+                else:
+                    parents.append(pos[nd.parent.index])
+        fp.write(marshal.dumps((tree.dump_version, ids, parents)))
+
+    # read a tree written by dump from the open file fp in one read
+    @classmethod
+    def load(cls, fp, node_class=None):
+        version, ids, parents = marshal.loads(fp.read())
+        if version != tree.dump_version:
+            raise Exception('unknown tree file version (%s)' % version)
+        t = cls(node_class)
+        nodes = []
+        for id, p in itertools.izip(ids, parents):
+            if p < 0:
+                # the first node is the root, the rest are orphans
+                nd = t.add_node(id)
+            elif p < len(nodes):
+                p_node = nodes[p]
+                nd = p_node._append(t._new_node(id))
+                nd._place(p_node)
+            else:
+                raise Exception('tree file parent (%d) follows its child' % p)
+            nodes.append(nd)
+        _set_heights(nodes)
+        return t
+
+    # create a node which is placed directly in the tree rather than the
+    # orphanage. it must be linked to a parent by the caller
+    def _new_node(self, id):
+        nd = self.node_class(id, self)
+        _add_key(self.names, id, nd.index)
+        self.nodes[nd.index] = self.orphans.pop(nd.index)
+        return nd
 
     def get_descendants(self, *args):
         rtn = {}
         for id in args:
-            rtn.update(self.get_node(id).get_descendants())
+            rtn.update(self._resolve(id).get_descendants())
         return rtn
 
 
@@ -105,34 +219,180 @@ class tree(object):
         # child = self.get_node(child_id)
         # child.set_parent(self.get_node(new_parent_id))
 
-    # get node via id
-    def get_node(self, id):
+    # get node via id. the first node added with the id is returned, unless
+    # parent is specified, in which case the first child of parent with the id
+    # is returned
+    def get_node(self, id, parent=None):
         # !!! what if parent doesn't exist?
-        if id in self.nodes:
-            return weakref.proxy(self.nodes[id])
-        elif id in self.orphans:
-            return weakref.proxy(self.orphans[id])
+        if parent is None:
+            keys = _get_keys(self.names, id)
         else:
-            raise Exception('node (%s) not in tree.nodes or tree.orphans' % id)
+            keys = _get_keys(self.kids, (self._resolve(parent).index, id))
+        if keys:
+            return self.get_node_by_key(keys[0])
+        raise Exception('node (%s) not in tree.nodes or tree.orphans' % id)
+
+    # get node via key
+    def get_node_by_key(self, key):
+        if key in self.nodes:
+            return weakref.proxy(self.nodes[key])
+        elif key in self.orphans:
+            return weakref.proxy(self.orphans[key])
+        else:
+            raise Exception('node key (%s) not in tree.nodes or tree.orphans' % key)
+
+    # return list of all nodes with id
+    def find(self, id):
+        return [self.get_node_by_key(key) for key in _get_keys(self.names, id)]
+
+    def has_node(self, id):
+        return id in self.names
 
     def get_node_ref(self, id):
         return weakref.proxy(self.get_node(id))
 
+    # return node referred to by a node or an id
+    def _resolve(self, ref):
+        if isinstance(ref, self.node_class):
+            return ref
+        return self.get_node(ref)
+
+    def __contains__(self, id):
+        return id in self.names
+
     def __str__(self):
         return self.root.__str__()
 
     def __repr__(self):
-        return self.nodes.__repr__()
+        return self.names.__repr__()
+
+
+
+# the id indexes of a tree store a single key for a name, and a list of keys
+# only once a name has more than one node. most names are unique, so this
+# saves a list per node
+
+# add key to the keys stored under name in index
+def _add_key(index, name, key):
+    keys = index.get(name)
+    if keys is None:
+        index[name] = key
+    elif isinstance(keys, list):
+        keys.append(key)
+    else:
+        index[name] = [keys, key]
+
+# set heights of newly linked nodes. nodes are listed parents before children,
+# e.g. in preorder or level order, and are all leaves of height 0
+def _set_heights(nodes):
+    for nd in reversed(nodes):
+        if nd.parent:
+            p_node = nd.parent
+            if nd._height + 1 > p_node._height:
+                p_node._height = nd._height + 1
+                p_node._tall   = 1
+            elif nd._height + 1 == p_node._height:
+                p_node._tall  += 1
+
+# remove key from the keys stored under name in index
+def _drop_key(index, name, key):
+    keys = index.get(name)
+    if keys is None:
+        return
+    if isinstance(keys, list):
+        keys.remove(key)
+        if len(keys) == 1:
+            index[name] = keys[0]
+    elif keys == key:
+        del index[name]
+
+# return list of keys stored under name in index
+def _get_keys(index, name):
+    keys = index.get(name)
+    if keys is None:
+        return []
+    if isinstance(keys, list):
+        return keys
+    return [keys]
+
+
+# private class
+# ordered view of the children of a node. the children are kept as a linked
+# list of siblings in the nodes themselves, so adding, removing and checking
+# membership of a child is O(1) regardless of the number of children. indexing
+# and index() use a table of positions, which costs one walk of the siblings
+# to build after any but the last child has been removed, and is O(1) after
+class _child_list(object):
+    __slots__ = ('_node',)
+
+    def __init__(self, node):
+        self._node = node
+
+    def __iter__(self):
+        x = self._node._first
+        while x is not None:
+            nxt = x._next
+            yield x
+            x = nxt
+
+    def __reversed__(self):
+        x = self._node._last
+        while x is not None:
+            prv = x._prev
+            yield x
+            x = prv
+
+    def __len__(self):
+        return self._node._degree
+
+    def __nonzero__(self):
+        return self._node._degree > 0
+
+    def __contains__(self, x):
+        return bool(x.parent) and x.parent.index == self._node.index
+
+    # return the children of the node and a map of child index to position.
+    # built once by walking the siblings, then kept up to date as children are
+    # appended, or the last child removed. removing any other child drops it
+    def _positions(self):
+        node = self._node
+        if node._order is None:
+            kids = list(self)
+            node._order = (kids, dict((x.index, n) for n, x in enumerate(kids)))
+        return node._order
+
+    def __getitem__(self, ndx):
+        return self._positions()[0][ndx]
+
+    def index(self, x):
+        ndx = self._positions()[1].get(x.index)
+        if ndx is None:
+            raise ValueError('%s is not a child of %s' % (x.id, self._node.id))
+        return ndx
+
+    def append(self, x):
+        self._node._link(x)
+
+    def remove(self, x):
+        if x not in self:
+            raise ValueError('%s is not a child of %s' % (x.id, self._node.id))
+        self._node.remove_child(x)
 
+    def __repr__(self):
+        return list(self).__repr__()
 
 
 # private class
 # object in a tree data structure. a node can have a parent and children nodes.
 class _node(object):
+    # nodes have no __dict__. a large include tree has hundreds of thousands
+    # of nodes, so each attribute is a slot
+    __slots__ = ('id', 'index', 'parent', '_tree', '_depth', '_height', '_tall',
+                 '_top', '_jump', '_first', '_last', '_prev', '_next', '_degree',
+                 '_order', '__weakref__')
     mark_prefix = ['╰─ ', '├─ ']
     lead_prefix = ['   ', '│  ']
-    _ref = {} # dict contains reference btw weakref of node and tree of node
-              # this allows for tree operations to be executed by the node
+    _count = itertools.count() # source of unique node indexes
 
     # creates an instance of _node and add it to incoming dictionary
     # as root or child of root. returns a weak proxy to instance
@@ -141,18 +401,25 @@ class _node(object):
         # if id in tree.nodes:
             # raise Exception('node id already in tree')
             # return
-        self = super(_node, obj).__new__(obj)
-        try:
-            _node.index += 1
-        except AttributeError:
-            _node.index = 0
-
+        self = object.__new__(obj)
 
         self.id       = id
-        self.index    = _node.index
-        self.children = []   # list of child nodes
+        self.index    = next(_node._count)
         self.parent   = 0    # make root temporarily
+        # children are linked through their _prev and _next siblings
+        self._first   = None # first child
+        self._last    = None # last child
+        self._prev    = None # previous sibling
+        self._next    = None # next sibling
+        self._degree  = 0    # number of children
+        self._order   = None # (children, child index -> position), or None
         nd = weakref.proxy(self)
+        # maintained by _link and _unlink as nodes move between parents
+        self._depth   = 0    # number of ancestors
+        self._height  = 0    # longest path to a leaf
+        self._tall    = 0    # number of children on the longest path
+        self._top     = nd   # topmost ancestor
+        self._jump    = nd   # ancestor to skip to when searching up the tree
         # try:
             # # add new node as child of root
             # tree.nodes.itervalues().next().root.add_child(nd)
@@ -163,19 +430,19 @@ class _node(object):
             # # no values in nds, i.e. there is no existing root. keep node as root
             # pass
         # tree.nodes[id] = self
-        tree.orphans[id] = self
-        # !!! this gets over written if two trees have the same node name !!!
-        # _node._ref[nd.__repr__()] = weakref.proxy(tree)
-        _node._ref[self.index] = weakref.proxy(tree)
+        tree.orphans[self.index] = self
+        # reference to tree of node. this allows for tree operations to be
+        # executed by the node
+        self._tree    = tree._proxy
         # nds[id] = self
         return nd
         # return weakref.proxy(self)
 
     # return string representation of self and descendants
     def __str__(self):
-        rtn = [('%s\n' % (self.id))]
-        rtn.extend(self.print_descendants())
-        return ('').join(rtn)
+        out = StringIO()
+        self.render(out)
+        return out.getvalue()
 
     # return string representation of self
     def __repr__(self):
@@ -185,18 +452,27 @@ class _node(object):
     # def __del__(self):
         # print '%s died' % (self.id)
 
+    @property
+    def key(self):
+        # unique integer identifying the node in its tree
+        return self.index
+
     @property
     def tree(self):
-        # return _node._ref[self.__repr__()]
-        return _node._ref[self.index]
+        return self._tree
+
+    @property
+    def children(self):
+        # ordered view of child nodes
+        return _child_list(self)
 
     @property
     def degree(self):
-        return len(self.children)
+        return self._degree
 
     @property
     def is_leaf(self):
-        if self.height:
+        if self._degree:
             return False
         else:
             return True
@@ -210,7 +486,7 @@ class _node(object):
 
     @property
     def is_orphan(self):
-        if self.__repr__() in self.tree.orphans:
+        if self.index in self.tree.orphans:
             return True
         else:
             return False
@@ -218,65 +494,133 @@ class _node(object):
     @property
     def level(self):
         # return the number of nodes to root
-        lvl = 0
-        root = self
-        while root.parent:
-            root = root.parent
-            lvl += 1
-        return lvl
+        return self._depth
 
     @property
     def height(self):
-        # return the number of nodes to root
-        hgt = 0
-        for child in self.children:
-            c_hgt = child.height + 1
-            if c_hgt > hgt: hgt = c_hgt
-        return hgt
+        # return the number of nodes to the deepest leaf
+        return self._height
 
     @property
     def root(self):
         # return the root node of tree
-        node = self
         if self.is_orphan:
             raise Exception('node is an orphan')
-        while not node.is_root:
-            node = node.parent
-        return node
+        return self._top
 
     @property
     def path_to_root(self):
         # return list of nodes between self and root, inclusively
         lst = [self]
-        if not self.is_root:
-            lst.extend(self.parent.path_to_root)
+        node = self.parent
+        while node:
+            lst.append(node)
+            node = node.parent
         return lst
 
+    # return the ancestor of self at depth, or self if depth is its own
+    def ancestor_at(self, depth):
+        if depth < 0 or depth > self._depth:
+            raise ValueError('no ancestor of %s at depth %d' % (self.id, depth))
+        node = self
+        while node._depth > depth:
+            if node._jump._depth >= depth:
+                node = node._jump
+            else:
+                node = node.parent
+        return node
+
+    def is_ancestor_of(self, other):
+        # return True if self is a proper ancestor of other
+        return (other._depth > self._depth
+                and other._top.index == self._top.index
+                and other.ancestor_at(self._depth).index == self.index)
+
     @property
     def ancestors(self):
         # return list of ancestor nodes
-        lst = []
-        if not self.is_root:
-            lst.extend(self.parent.path_to_root)
-        return lst
+        return self.path_to_root[1:]
 
     @property
     def siblings(self):
-        # return list of ancestor nodes
+        # return list of sibling nodes
         lst = []
-        if not self.is_root:
-            lst.extend(self.parent.children)
-            lst.remove(weakref.proxy(self))
+        if self.parent:
+            lst = [x for x in self.parent.children if x.index != self.index]
         return lst
 
+    @property
+    def is_first(self):
+        return self._prev is None
+
+    @property
+    def is_last(self):
+        return self._next is None
+
+    @property
+    def next_sibling(self):
+        return self._next
+
+    @property
+    def prev_sibling(self):
+        return self._prev
+
     @property
     def descendants(self):
-        # return list of descendant nodes
-        lst = []
-        for x in self.children:
-            lst.extend(x.descendants)
-            lst.append(x)
-        return lst
+        # return list of descendant nodes, children first
+        return list(self.postorder(include_self=False))
+
+    # traversals are generators using an explicit stack, so they never recurse
+    # and nodes are produced as the tree is walked
+
+    def preorder(self, include_self=True):
+        # generate nodes of subtree, parents before children
+        if include_self:
+            stack = [weakref.proxy(self)]
+        else:
+            stack = list(reversed(self.children))
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def postorder(self, include_self=True):
+        # generate nodes of subtree, children before parents
+        stack = [(weakref.proxy(self), iter(self.children))]
+        while stack:
+            node, kids = stack[-1]
+            for kid in kids:
+                stack.append((kid, iter(kid.children)))
+                break
+            else:
+                stack.pop()
+                if stack or include_self:
+                    yield node
+
+    def levelorder(self, include_self=True):
+        # generate nodes of subtree, level by level
+        if include_self:
+            queue = collections.deque([weakref.proxy(self)])
+        else:
+            queue = collections.deque(self.children)
+        while queue:
+            node = queue.popleft()
+            yield node
+            queue.extend(node.children)
+
+    def _walk(self):
+        # generate (node, depth below self, is last child) of descendants in
+        # preorder
+        stack = [(x, 1) for x in reversed(self.children)]
+        while stack:
+            node, depth = stack.pop()
+            yield node, depth, node._next is None
+            stack.extend((x, depth + 1) for x in reversed(node.children))
+
+    # return a weak reference to the node itself, also when called through a
+    # weak reference
+    def _weak(self):
+        return weakref.proxy(self)
 
     @property
     def info(self):
@@ -300,13 +644,13 @@ class _node(object):
 
 
     def add_node(self, id):
-        return self.tree.add_node(id, parent=self.id)
+        return self.tree.add_node(id, parent=self)
 
     def insert_node(self, id, after=False):
         if after:
-            return self.tree.insert_node(id, after=self.id)
+            return self.tree.insert_node(id, after=self)
         else:
-            return self.tree.insert_node(id, before=self.id)
+            return self.tree.insert_node(id, before=self)
 
 
     # add child node to self and level up child and descendants
@@ -314,9 +658,8 @@ class _node(object):
         # print 'add', child.id, 'to parent', self.id
         # print self
         # print child
-        if child in self.path_to_root:
-            print 'child', child.id, 'ancestor of self', self.id
-            # child.remove_child(self)
+        if child.index == self.index or child.is_ancestor_of(self):
+            raise tree.CycleError('%s is an ancestor of %s' % (child.id, self.id))
 
         # print type(child)
         if child.parent:
@@ -326,10 +669,7 @@ class _node(object):
 
         # for r in weakref.getweakrefs(child):
             # print 'xxx weakref found child', child.id, hex(id(child.id)), hex(id(r))
-        self.children.append(child) # add new child to list of children
-        # if child.parent:
-            # child.parent.remove_child(child)
-        child.parent = self
+        self._link(child) # add new child to list of children
 
 
     def adopt(self, child):
@@ -342,19 +682,132 @@ class _node(object):
         # print 'child\n', child.info
         # print 'parent\n', self.info
         self.add_child(child)
-        self.tree.nodes[child.id] = self.tree.orphans.pop(child.__repr__(), None)
+        self.tree.nodes[child.index] = self.tree.orphans.pop(child.index, None)
 
     def adopt_subtree(self, child):
-        if self.__repr__() not in self.tree.nodes and child.__repr__() not in self.tree.nodes:
+        if self.index not in self.tree.nodes and child.index not in self.tree.nodes:
             raise Exception('subtree must be in same tree as node')
+        if child.index == self.index or child.is_ancestor_of(self):
+            raise tree.CycleError('%s is an ancestor of %s' % (child.id, self.id))
         # if subtree root already has a parent. remove subtree root from its
         # old parent's child list
         if child.parent:
-            child.parent.children.remove(child)
-        # set subtree parent to self
+            child.parent.remove_child(child)
+        # set subtree parent to self and add subtree root to self's children list
+        self._link(child)
+
+    # attach child, and its subtree, as the last child of self. the depth and
+    # top of the subtree and the height of self and its ancestors are updated
+    def _link(self, child):
+        child = self._append(child)
+        child._set_depth()
+        self._raise_height(child._height + 1)
+
+    # add child as the last child of self and return a weak reference to it.
+    # depth, top and heights are left to the caller
+    def _append(self, child):
+        child = child._weak()
+        child._prev = self._last
+        child._next = None
+        if self._last is None:
+            self._first = child
+        else:
+            self._last._next = child
+        self._last = child
+        self._degree += 1
+        if self._order is not None:
+            self._order[1][child.index] = len(self._order[0])
+            self._order[0].append(child)
         child.parent = self
-        # add subtree root to self's children list
-        self.children.append(child)
+        _add_key(self._tree.kids, (self.index, child.id), child.index)
+        return child
+
+    # count children of self which reach hgt, and raise heights up the tree
+    # until an ancestor is already high enough
+    def _raise_height(self, hgt, count=1):
+        node = self
+        while node:
+            if hgt > node._height:
+                node._height = hgt
+                node._tall   = count
+            elif hgt == node._height:
+                node._tall  += count
+                break
+            else:
+                break
+            hgt += 1
+            count = 1
+            node = node.parent
+
+    # detach child, and its subtree, from self. child becomes the top of its
+    # subtree and the height of self and its ancestors are recomputed
+    def _unlink(self, child):
+        if child._prev is None:
+            self._first = child._next
+        else:
+            child._prev._next = child._next
+        if child._next is None:
+            self._last = child._prev
+        else:
+            child._next._prev = child._prev
+        # positions are kept when the last child is removed, and are worked
+        # out again on the next lookup when any other child is
+        if self._order is not None and child._next is None:
+            self._order[0].pop()
+            del self._order[1][child.index]
+        else:
+            self._order = None
+        child._prev = child._next = None
+        self._degree -= 1
+        child.parent = 0
+        _drop_key(self._tree.kids, (self.index, child.id), child.index)
+        child._set_depth()
+        # heights only change when the last child on the longest path of a
+        # node is removed or lowered
+        hgt  = child._height + 1
+        node = self
+        while node and hgt == node._height:
+            node._tall -= 1
+            if node._tall:
+                break
+            old = node._height
+            node._height = 0
+            for x in node.children:
+                if x._height + 1 > node._height:
+                    node._height = x._height + 1
+                    node._tall   = 1
+                elif x._height + 1 == node._height:
+                    node._tall  += 1
+            hgt = old + 1
+            node = node.parent
+
+    # set depth, top and jump pointers of self and its descendants from the
+    # parent of self
+    def _set_depth(self):
+        if self.parent:
+            self._place(self.parent)
+        else:
+            nd = weakref.proxy(self)
+            self._depth = 0
+            self._top   = nd
+            self._jump  = nd
+        stack = list(self.children)
+        while stack:
+            node = stack.pop()
+            node._place(node.parent)
+            stack.extend(node.children)
+
+    # set depth, top and jump pointer of self as a child of parent. jump
+    # pointers skip 1, 3, 7, ... 2^k-1 ancestors, so any ancestor is reached
+    # in O(log depth) steps (Myers' skew binary jump pointers)
+    def _place(self, parent):
+        self._depth = parent._depth + 1
+        self._top   = parent._top
+        jump = parent._jump
+        if parent._depth - jump._depth == jump._depth - jump._jump._depth:
+            self._jump = jump._jump
+        else:
+            self._jump = parent
 
 
 
@@ -373,27 +826,17 @@ class _node(object):
         son.orphan()
 
     def orphan(self):
-        if self not in self.tree.nodes:
+        if self.index not in self.tree.nodes:
             raise Exception('node is already an orphan')
-        self.tree.orphans[self.id] = self.tree.nodes.pop(self.__repr__(), None)
+        self.tree.orphans[self.index] = self.tree.nodes.pop(self.index, None)
         if self.parent:
             self.parent.remove_child(self)
             self.parent = 0
 
     # remove child node if it exists
-    # children are assigned as weak references; so the reference
-    # itself has to be found and removed
     def remove_child(self, kid):
-        # get all weakrefs to kid
-        # print 'from', self.id, 'delete kid', kid.id
-        for r in weakref.getweakrefs(kid):
-            # if weakref to kid in children
-            if r in self.children:
-                self.children.remove(r)
-                kid.parent = 0
-                # print ' delete weakref to', kid.id
-            # else:
-                # print ' no weakref to', kid.id
+        if kid in self.children:
+            self._unlink(kid)
 
 
 
@@ -408,57 +851,75 @@ class _node(object):
     ###### i don't like this name - i don't know why it's needed ######
     # return a dictionary of nodes from node and descendants
     def list_children(self):
-        rtn = {}
-        rtn[self.id] = self
-        for x in self.children:
-            rtn.update(x.list_children())
-        return rtn
+        return dict((x.id, x) for x in self.preorder())
 
     def get_descendants(self):
-        rtn = {}
-        for x in self.children:
-            rtn[x.id] = x
-            rtn.update(x.list_children())
-        return rtn
+        return dict((x.id, x) for x in self.preorder(include_self=False))
 
     # return subree id's children first
     def list_subtree_ids(self):
-        rtn = []
-        for x in self.children:
-            rtn.extend(x.list_subtree_ids())
-        rtn.append(self.id)
-        return rtn
+        return [x.id for x in self.postorder()]
 
     # return a list of descendants with leaders and markers
-    def print_descendants(self, prefix=[]):
-        rtn = []
-        # called from outside of recursion
-        if not prefix:
-            _node.local_level = self.level
-
-        # print '@@@', self.degree, self.id
-        for x in self.children:
-            leader = ['']
+    def print_descendants(self):
+        return list(itertools.islice(self.lines(), 1, None))
 
-            level_diff = x.level - _node.local_level
-            prefix = prefix[:(level_diff-1)]
+    # write self and its descendants to stream, one line at a time
+    def render(self, stream, max_depth=None, collapse=False):
+        for line in self.lines(max_depth, collapse):
+            stream.write(line)
 
-            for y in prefix:
-                leader.append(_node.lead_prefix[y])
+    def lines(self, max_depth=None, collapse=False):
+        """Generate the lines drawing self and its descendants
 
-            if x.parent.children.index(x) == (len(x.parent.children)-1):
-                prefix.append(0)
-                leader.append(_node.mark_prefix[0])
-            else:
-                prefix.append(1)
-                leader.append(_node.mark_prefix[1])
-
-            rtn.append('%s%s\n' % (('').join(leader),  x.id))
-
-            # recursive call. pass in current prefix list
-            rtn.extend(x.print_descendants(prefix=prefix))
+        Descendants more than max_depth levels below self are left out, and
+        nodes whose children are left out are marked with '...'. If collapse
+        is set, a subtree which is the same as one already drawn is drawn as
+        its top node marked with '(repeated)'. A max_depth of 0 draws self only
 
-        return rtn
+        """
+        if max_depth is not None and max_depth < 1 and self._first:
+            yield '%s ...\n' % self.id
+            return
+        if collapse:
+            shapes = self._shapes()
+            seen = set()
+        yield '%s\n' % self.id
+        # leads[d] is the leader drawn before the children of a node d levels
+        # below self. it is built once per node rather than once per line
+        leads = ['']
+        stack = [(x, 1) for x in reversed(self.children)]
+        while stack:
+            node, depth = stack.pop()
+            del leads[depth:]
+            is_last = node._next is None
+            lead = leads[-1]
+            line = '%s%s%s' % (lead, _node.mark_prefix[not is_last], node.id)
+            if not node._first:
+                yield line + '\n'
+                continue
+            if collapse:
+                shape = shapes[node.index]
+                if shape in seen:
+                    yield line + ' (repeated)\n'
+                    continue
+                seen.add(shape)
+            if max_depth is not None and depth >= max_depth:
+                yield line + ' ...\n'
+                continue
+            yield line + '\n'
+            leads.append(lead + _node.lead_prefix[not is_last])
+            stack.extend((x, depth + 1) for x in reversed(node.children))
+
+    # return a map of node index to a number which is the same for nodes
+    # whose subtrees have the same ids and shape
+    def _shapes(self):
+        numbers = {}   # (id, child shapes) -> shape number
+        shapes  = {}   # node index -> shape number
+        for node in self.postorder():
+            key = (node.id, tuple(shapes[x.index] for x in node.children))
+            shapes[node.index] = numbers.setdefault(key, len(numbers))
+        return shapes
 
 
     # delete self
@@ -470,13 +931,13 @@ class _node(object):
         if self.parent:
             # print 'delete child of', self.parent.id
             self.parent.remove_child(self)
-        self.children = []
         # remove hard reference to node, in tree.nodes, to allow for 
         # garbage collection
-        self.tree.nodes.pop(self.__repr__(), None)
-        # remove weak reference to node in _node._ref dict
-        # _node._ref.pop(self.__repr__(), None)
-        _node._ref.pop(self.index, None)
+        self.tree.nodes.pop(self.index, None)
+        self.tree.orphans.pop(self.index, None)
+        _drop_key(self.tree.names, self.id, self.index)
+        # remove reference to tree of node
+        self._tree = None
 
 
     # delete descendants nodes and self